@@ -0,0 +1,216 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from connections import ConnectionPool
+
+
+class ContractCache:
+    """Bounded LRU cache of parsed contracts.
+
+    Each entry remembers the revision it was parsed from (e.g. the file's mtime/size/inode) and is only served
+    while the caller's current revision still matches. Entries are weighted by their on-disk size in bytes.
+    Cached contracts are shared between threads and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # contract_id -> (revision, size, contract)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, contract_id, revision):
+        with self._lock:
+            entry = self._entries.get(contract_id)
+            if entry is None or entry[0] != revision:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(contract_id)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, contract_id, revision, size, contract):
+        with self._lock:
+            self._discard(contract_id)
+            if size > self.max_bytes:
+                return
+            self._entries[contract_id] = (revision, size, contract)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def invalidate(self, contract_id):
+        with self._lock:
+            self._discard(contract_id)
+
+    def _discard(self, contract_id):
+        entry = self._entries.pop(contract_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+class TTLCache:
+    """Thread-safe cache whose entries expire ttl seconds after they were stored.
+    Holds at most max_entries; the least recently used entry is evicted first."""
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop an entry. Returns its value if it was cached and still fresh, else None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl
+            }
+
+
+class ExplanationCache:
+    """Two-tier cache for AI responses that depend only on their inputs, e.g. clause explanations.
+
+    Keys are hashes of everything that shapes the response (see key()). Recent entries are kept in an in-memory
+    LRU of memory_entries; all entries are kept in a SQLite table shared by every process, which evicts the least
+    recently used rows once their text passes max_bytes.
+    """
+
+    def __init__(self, db_path, memory_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict() # key -> value
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.pool = ConnectionPool(self.db_path)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS cached_responses
+                                (key TEXT PRIMARY KEY, value TEXT, size INTEGER, created_at REAL, last_used REAL)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_cached_responses_last_used ON cached_responses (last_used)')
+            conn.commit()
+
+    @staticmethod
+    def key(*parts):
+        """Hash the inputs of a response, e.g. key(model, system_prompt, clause_text)."""
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT value FROM cached_responses WHERE key = ?', (key,)).fetchone()
+            if row:
+                conn.execute('UPDATE cached_responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        with self._lock:
+            if not row:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        now = time.time()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR REPLACE INTO cached_responses (key, value, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                           (key, value, len(value.encode()), now, now))
+            # Puts follow a slow API call, so summing the sizes here is cheap by comparison
+            cursor.execute('SELECT COALESCE(SUM(size), 0) FROM cached_responses')
+            excess = cursor.fetchone()[0] - self.max_bytes
+            if excess > 0:
+                # Evict least recently used rows down to 90% of max_bytes, so evictions don't run on every put
+                excess += self.max_bytes // 10
+                evicted = []
+                for evicted_key, size in conn.execute('SELECT key, size FROM cached_responses ORDER BY last_used'):
+                    if excess <= 0:
+                        break
+                    evicted.append((evicted_key,))
+                    excess -= size
+                cursor.executemany('DELETE FROM cached_responses WHERE key = ?', evicted)
+            conn.commit()
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cached_responses').fetchone()
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": entries,
+                "disk_bytes": size,
+                "max_bytes": self.max_bytes
+            }
@@ -0,0 +1,138 @@
+'''Encoding of contract snapshots and operation log records, with msgspec.
+
+Snapshots can be written as compact JSON (the default), indented JSON ("pretty", as older versions wrote them) or
+MessagePack ("msgpack", smaller and faster still). Every format is checked against the contract schema below when
+it is decoded, so older snapshots read transparently. The structure (clauses, versions, comments, collaborators, ids,
+dates and the revision) is typed strictly. Content the routes store as the client sent it (titles, texts, names)
+is typed Any. Fields outside the schema are kept as they are.
+
+The same schema checks changes before they are stored (validate_contract, validate_record), so the app never writes
+a contract it couldn't read back.
+'''
+from typing import Any, NotRequired, TypedDict
+import msgspec
+from model import Contract
+
+SNAPSHOT_FORMATS = ("json", "pretty", "msgpack")
+
+
+class InvalidContract(ValueError):
+    """A contract or change that doesn't fit the contract schema, e.g. a user id that isn't a string."""
+
+
+class VersionDocument(TypedDict):
+    date: str
+    full_text: NotRequired[Any] # the latest version and keyframes (see versions.py)
+    delta: NotRequired[list[list[int | str]]] # older versions: [[start, end, text], ...]
+    publisher: NotRequired[Any]
+    publisher_id: NotRequired[Any]
+    publisher_name: NotRequired[Any]
+
+
+class CommentDocument(TypedDict):
+    comment_id: str
+    user_id: str
+    email: Any
+    name: Any
+    comment: Any
+    date: str
+
+
+class ClauseDocument(TypedDict):
+    clause_id: str
+    short_title: Any
+    versions: list[VersionDocument]
+    comments: NotRequired[list[CommentDocument]]
+
+
+class CollaboratorDocument(TypedDict):
+    user_id: str
+    name: NotRequired[Any]
+    email: NotRequired[Any]
+    role: NotRequired[Any]
+    added_date: NotRequired[str | None]
+
+
+class MetadataDocument(TypedDict):
+    contract_id: str
+    creator_id: str
+    creator_name: Any
+    title: Any
+    description: Any
+    creation_date: str
+    status: str
+    collaborators: list[CollaboratorDocument]
+    revision: NotRequired[int]
+
+
+class ContractDocument(TypedDict):
+    metadata: MetadataDocument
+    clauses: list[ClauseDocument]
+
+
+# Decoded without a type, so that fields outside the schema survive, then checked with msgspec.convert
+_json_encoder = msgspec.json.Encoder()
+_msgpack_encoder = msgspec.msgpack.Encoder()
+_json_decoder = msgspec.json.Decoder()
+_msgpack_decoder = msgspec.msgpack.Decoder()
+
+# What each operation record adds to a contract (see operations.py)
+_RECORD_SCHEMAS = {
+    "add_clause": ("clause", ClauseDocument),
+    "update_clause": ("version", VersionDocument),
+    "add_collaborator": ("collaborator", CollaboratorDocument),
+    "add_comment": ("comment", CommentDocument),
+}
+
+
+def snapshot_extension(snapshot_format):
+    return ".msgpack" if snapshot_format == "msgpack" else ".json"
+
+
+def encode_contract(contract, snapshot_format="json"):
+    if snapshot_format == "msgpack":
+        return _msgpack_encoder.encode(contract)
+    data = _json_encoder.encode(contract)
+    return msgspec.json.format(data, indent=4) if snapshot_format == "pretty" else data
+
+
+def validate_contract(contract):
+    """Raise InvalidContract if a contract doesn't fit the schema."""
+    try:
+        msgspec.convert(contract, ContractDocument)
+    except msgspec.ValidationError as e:
+        raise InvalidContract(f"Invalid contract: {e}") from e
+
+
+def validate_record(record):
+    """Raise InvalidContract if what an operation record adds to a contract doesn't fit the schema."""
+    key, schema = _RECORD_SCHEMAS.get(record["op"], (None, None))
+    if schema is None:
+        return
+    try:
+        msgspec.convert(record[key], schema)
+    except msgspec.ValidationError as e:
+        raise InvalidContract(f"Invalid {key}: {e}") from e
+
+
+def decode_contract(data, snapshot_format="json"):
+    """Decode and validate a snapshot into a Contract. Raises ValueError if it is malformed or doesn't fit the schema."""
+    try:
+        contract = (_msgpack_decoder if snapshot_format == "msgpack" else _json_decoder).decode(data)
+    except msgspec.DecodeError as e:
+        raise ValueError(f"Invalid contract snapshot: {e}") from e
+    validate_contract(contract)
+    return Contract(contract)
+
+
+def encode_record(record):
+    """One operation log line, without the newline."""
+    return _json_encoder.encode(record)
+
+
+def decode_record(line):
+    """Raises ValueError for a malformed line, e.g. a record torn by a crash mid-append."""
+    try:
+        return _json_decoder.decode(line)
+    except msgspec.DecodeError as e:
+        raise ValueError(str(e)) from e
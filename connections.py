@@ -0,0 +1,63 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """A small pool of reusable SQLite connections to one database file.
+
+    Connections are opened once and kept, so requests skip connection setup, re-reading the schema and
+    re-preparing statements (sqlite3 caches prepared statements per connection). The database runs in WAL
+    mode, so readers are never blocked by a writer and commits don't need a full rollback-journal fsync.
+    """
+
+    def __init__(self, db_path, size=8, timeout=30):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue() # most recently used first, its page cache is warm
+        self._created = 1
+        self._lock = threading.Lock()
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL') # persistent, so setting it once per database is enough
+        self._idle.put(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA synchronous=NORMAL') # durable across application crashes; safe with WAL
+        conn.execute('PRAGMA cache_size=-16000') # 16 MB page cache per connection
+        conn.execute('PRAGMA mmap_size=268435456') # read pages through a 256 MB memory map
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1 # give the slot back, or the pool would shrink for good
+                raise
+        return self._idle.get(timeout=self.timeout)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection. Like `with sqlite3.connect(...)`, it commits on success and rolls back on error."""
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
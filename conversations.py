@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from connections import ConnectionPool
+
+
+class ConversationStore:
+    """Clause Q&A conversations kept on the server, one message per row.
+
+    Conversations are keyed by owner (a random chat id kept in the session cookie), contract and clause.
+    They can't live in the cookie itself: a streamed answer is only complete after the response headers,
+    and with them the cookie, have been sent.
+
+    Older messages can be folded into a stored summary (see set_summary), so only the messages after it need to be
+    loaded. Conversations idle for more than ttl seconds expire.
+    """
+
+    PURGE_INTERVAL = 3600 # seconds between sweeps for expired conversations
+
+    def __init__(self, db_path, ttl=7 * 24 * 3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.pool = ConnectionPool(self.db_path)
+        self._last_purge = None
+        self._purge_lock = threading.Lock()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS conversation_messages
+                                (message_id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT, contract_id TEXT, clause_id TEXT,
+                                 role TEXT, content TEXT, created_at TEXT)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_conversation_messages_chat
+                              ON conversation_messages (chat_id, contract_id, clause_id, message_id)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS conversation_summaries
+                                (chat_id TEXT, contract_id TEXT, clause_id TEXT, summary TEXT, summarized_through INTEGER,
+                                 PRIMARY KEY (chat_id, contract_id, clause_id))''')
+            conn.commit()
+
+    def _cutoff(self):
+        return (datetime.now() - timedelta(seconds=self.ttl)).isoformat()
+
+    def _delete(self, cursor, chat_id, contract_id, clause_id):
+        for table in ("conversation_messages", "conversation_summaries"):
+            cursor.execute(f'DELETE FROM {table} WHERE chat_id = ? AND contract_id = ? AND clause_id = ?', (chat_id, contract_id, clause_id))
+
+    def _expire_if_idle(self, cursor, key):
+        """Delete the conversation if it is idle for more than ttl seconds. Returns whether it was."""
+        cursor.execute('''SELECT created_at FROM conversation_messages WHERE chat_id = ? AND contract_id = ? AND clause_id = ?
+                          ORDER BY message_id DESC LIMIT 1''', key)
+        last = cursor.fetchone()
+        if last and last[0] < self._cutoff():
+            self._delete(cursor, *key)
+            return True
+        return False
+
+    def history(self, chat_id, contract_id, clause_id, after=0):
+        """Return a conversation's messages after message id `after`, oldest first, as [{"message_id", "role", "content"}, ...].
+        An expired conversation is deleted and comes back empty."""
+        key = (chat_id, contract_id, clause_id)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if self._expire_if_idle(cursor, key):
+                conn.commit()
+                return []
+            cursor.execute('''SELECT message_id, role, content FROM conversation_messages
+                              WHERE chat_id = ? AND contract_id = ? AND clause_id = ? AND message_id > ? ORDER BY message_id''',
+                           key + (after,))
+            return [{"message_id": row[0], "role": row[1], "content": row[2]} for row in cursor.fetchall()]
+
+    def summary(self, chat_id, contract_id, clause_id):
+        """Return (summary, id of the last message it covers), or (None, 0) if there is no summary yet.
+        An expired conversation is deleted, summary included, like in history()."""
+        key = (chat_id, contract_id, clause_id)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if self._expire_if_idle(cursor, key):
+                conn.commit()
+                return None, 0
+            row = cursor.execute('''SELECT summary, summarized_through FROM conversation_summaries
+                                    WHERE chat_id = ? AND contract_id = ? AND clause_id = ?''', key).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def set_summary(self, chat_id, contract_id, clause_id, summary, summarized_through):
+        with self.pool.connection() as conn:
+            conn.execute('''INSERT OR REPLACE INTO conversation_summaries (chat_id, contract_id, clause_id, summary, summarized_through)
+                            VALUES (?, ?, ?, ?, ?)''', (chat_id, contract_id, clause_id, summary, summarized_through))
+            conn.commit()
+
+    def append(self, chat_id, contract_id, clause_id, messages):
+        created_at = datetime.now().isoformat()
+        with self.pool.connection() as conn:
+            conn.executemany('''INSERT INTO conversation_messages (chat_id, contract_id, clause_id, role, content, created_at)
+                                VALUES (?, ?, ?, ?, ?, ?)''',
+                             [(chat_id, contract_id, clause_id, message["role"], message["content"], created_at) for message in messages])
+            conn.commit()
+        self._purge_if_due()
+
+    def _purge_if_due(self):
+        with self._purge_lock:
+            if self._last_purge is not None and time.monotonic() - self._last_purge < self.PURGE_INTERVAL:
+                return
+            self._last_purge = time.monotonic()
+        self.purge_expired()
+
+    def purge_expired(self):
+        """Delete every conversation idle for more than ttl seconds."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT chat_id, contract_id, clause_id FROM conversation_messages
+                              GROUP BY chat_id, contract_id, clause_id HAVING MAX(created_at) < ?''', (self._cutoff(),))
+            for key in cursor.fetchall():
+                self._delete(cursor, *key)
+            conn.commit()
@@ -1,40 +1,151 @@
-import json
 import os
 from datetime import datetime
 import uuid
-import threading
+import hashlib
+import json
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from docx import Document
 import re
-import openai
-from openai import OpenAI
 from dotenv import load_dotenv
+from locks import ContractLocks
+from cache import ContractCache, ExplanationCache
+from storage import JsonFileStore, SQLiteStore
+from codec import validate_contract, validate_record
+from operations import apply_operation
+from versions import expand_versions, version_text
+from index import ContractIndex
+from edits import ContractEdit
+from model import Contract, contract_role, find_clause
+from templates import TemplateRegistry
+from conversations import ConversationStore
+from llm import LLMGateway, LLMUnavailable, OpenAIBackend, StubBackend
 
 load_dotenv()
 
-client = OpenAI(api_key = os.getenv("OPENAI_API_KEY"))
+EXPLAIN_MODEL = "gpt-4"
+EXPLAIN_PROMPT = "You are a legal AI assistant that explains contract clauses. Explain the provided clause from a contract in a simple and clear way, in not more than 200 words:"
+QUESTION_MODEL = "gpt-4"
+QUESTION_PROMPT = "You are a legal AI assistant that answers user questions in not more than 200 words, based on contract clauses."
+CONTRACT_SUMMARY_PROMPT = "You are a legal AI assistant. From these plain-language explanations of a contract's clauses, summarize the whole contract for a reviewer in not more than 300 words: what it does, the key obligations, and anything worth raising before signing:"
+SUMMARY_PROMPT = "Summarize this conversation about a contract clause in not more than 150 words. Keep the facts, positions and open questions:"
+# Recent turns of a clause conversation sent with each question; older ones are summarized
+HISTORY_TOKEN_BUDGET = 1500
+
+def estimate_tokens(text):
+    '''Rough token count (about 4 characters per token for English text)'''
+    return len(text) // 4 + 1
+
+def render_docx(contract, docx_path):
+    '''Write a contract to docx_path as a DOCX file. A plain function, so bulk exports can run it in worker processes.'''
+    metadata = contract["metadata"]
+    doc = Document()
+    
+    # Format creation date
+    creation_date = metadata["creation_date"].split("T")[0] # Extract YYYY-MM-DD
+    
+    # Title
+    doc.add_heading(metadata["title"], level=1)
+    
+    # Contract Info
+    doc.add_paragraph(f"Created by: {metadata['creator_name']}")
+    doc.add_paragraph(f"Creation Date: {creation_date}")
+    doc.add_paragraph(f"Status: {metadata['status']}")
+    doc.add_paragraph(f"Description: {metadata['description']}\n")
+    
+    # Clauses
+    # Clause numbering
+    clause_number = 1
+    for clause in contract["clauses"]:
+        doc.add_heading(f"{clause_number}.{clause['short_title']}", level = 3)
+        
+        # Get latest version of the clause
+        latest_version = clause["versions"][0]
+        clause_text = latest_version["full_text"]
+        
+        # Sentence-level numbering
+        sentence_number = 1
+        for sentence in clause_text.split("\n"):
+            sentence = sentence.strip()
+            if sentence:
+                doc.add_paragraph(f"{clause_number}.{sentence_number} {sentence}")
+                sentence_number += 1
+            
+        clause_number += 1 # Increment for the next clause
+        
+    # Save under a temporary name first, so a concurrent export never serves a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(docx_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        doc.save(tmp_path)
+        os.replace(tmp_path, docx_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 class Core:
-    def __init__(self):
+    # Parts of a contract a GET can ask for with fields=, and the named presets for view=.
+    # Clauses always carry their latest version; "history" adds the older ones, "comments" the comments.
+    CONTRACT_FIELDS = ("metadata", "clauses", "history", "comments")
+    CONTRACT_VIEWS = {
+        "full": CONTRACT_FIELDS,
+        "latest": ("metadata", "clauses", "comments"),
+        "compact": ("metadata", "clauses"),
+        "metadata": ("metadata",)
+    }
+    DOCX_FORMAT = 1 # bump when convert_to_docx lays documents out differently, so cached exports are regenerated
+
+    def __init__(self, multiprocess=False, cache_bytes=64 * 1024 * 1024, operation_log=False, storage="json",
+                 llm_backend="openai", llm_concurrency=8, llm_timeout=60, snapshot_format="json"):
         self.contract_directory = "../store/json"
+        self.contract_db_path = "../store/contracts.db"
+        self.index_db_path = "../store/index.db"
+        self.explanation_db_path = "../store/explanations.db"
+        self.conversation_db_path = "../store/conversations.db"
         self.contract_docx_directory = "../store/docx"
-        self.lock = threading.Lock() # lock for thread safety
-        if not os.path.exists(self.contract_directory):
-            os.makedirs(self.contract_directory)
-        if not os.path.exists(self.contract_docx_directory):
-            os.makedirs(self.contract_docx_directory)
+        self.contract_export_directory = "../store/exports" # ZIP archives of bulk exports
+        self.template_directory = "../store/templates"
+        # Per-contract read/write locks for thread safety. In multi-process mode they are also
+        # backed by fcntl locks so worker processes sharing the store don't overwrite each other's edits.
+        lock_directory = os.path.join(self.contract_directory, ".locks") if multiprocess else None
+        self.locks = ContractLocks(lock_directory)
+        self.cache = ContractCache(cache_bytes) # parsed contracts, validated against the store's revision on every read
+        if storage == "sqlite":
+            # Normalized tables, so an edit touches only the rows it changes
+            self.store = SQLiteStore(self.contract_db_path, self.cache)
+        else:
+            # One file per contract, compact JSON or MessagePack (snapshot_format, see codec.py).
+            # With operation_log, edits are appended to a per-contract log instead of rewriting the file
+            self.store = JsonFileStore(self.contract_directory, self.locks, self.cache, log_operations=operation_log,
+                                       snapshot_format=snapshot_format)
+        # Explanations depend only on model, prompt and clause text, so identical (e.g. template) clauses share one
+        self.explanations = ExplanationCache(self.explanation_db_path)
+        self.conversations = ConversationStore(self.conversation_db_path)
+        # All model calls go through the gateway: bounded concurrency, deadlines, retries and a circuit breaker.
+        # llm_backend="stub" answers locally, for tests and load tests without network
+        backend = StubBackend() if llm_backend == "stub" else OpenAIBackend(os.getenv("OPENAI_API_KEY"), max_connections=llm_concurrency)
+        self.llm = LLMGateway(backend, max_concurrency=llm_concurrency, timeout=llm_timeout)
+        self._explain_pool = ThreadPoolExecutor(max_workers=llm_concurrency, thread_name_prefix="explain")
+        # Metadata and clause search index, rebuilt if it has drifted from the store or predates clause search
+        self.index = ContractIndex(self.index_db_path)
+        if self.index.rebuild_needed or self.index.count() != len(self.store.list_ids()):
+            self.index.rebuild(self.store)
+        for directory in (self.contract_docx_directory, self.contract_export_directory, self.template_directory):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        # Templates are validated once and served from memory; edited files are picked up within seconds
+        self.templates = TemplateRegistry(self.template_directory)
 
     def _generate_id(self):
         return str(uuid.uuid4())
 
-    def _get_contract_path(self, contract_id):
-        return f"{self.contract_directory}/{contract_id}.json"
-
     def create_contract(self, creator_id, creator_name, title, description, template_data=None, collaborators=None):
-        """Create a new contract, either from scratch or from a template."""
+        """Create a new contract, either from scratch or from a template (see TemplateRegistry)."""
         contract_id = self._generate_id()
         creation_date = datetime.now().isoformat()
         
-        contract = {
+        contract = Contract({
             "metadata": {
                 "contract_id": contract_id,
                 "creator_id": creator_id,
@@ -43,10 +154,11 @@ class Core:
                 "description": description,
                 "creation_date": creation_date,
                 "status": "Draft",
-                "collaborators": collaborators if collaborators else []
+                "collaborators": collaborators if collaborators else [],
+                "revision": 0 # bumped by every edit
             },
             "clauses": []
-        }
+        })
             # Load clauses if using a template
         if template_data:
             for clause in template_data["clauses"]:
@@ -68,122 +180,178 @@ class Core:
         return contract_id
         
 
+    def _read_contract(self, contract_id):
+        """Load a private, modifiable copy of a contract. Callers must hold the contract's write lock."""
+        return self.store.read(contract_id)
+
+    def _stage(self, contract, op):
+        """Apply an operation to a contract in memory only. It is persisted by _commit.
+        Raises InvalidContract if the change doesn't fit the contract schema (see codec.py)."""
+        validate_record(op)
+        apply_operation(contract, op)
+        op["rev"] = contract["metadata"]["revision"]
+
+    def _commit(self, contract, ops):
+        """Persist staged operations. Callers must hold the contract's write lock."""
+        self.store.commit(contract, ops)
+        self.index.update(contract, ops)
+
+    def _new_clause(self, short_title, full_text, publisher):
+        return {
+            "clause_id": self._generate_id(),
+            "short_title": short_title,
+            "versions": [{
+                "date": datetime.now().isoformat(),
+                "full_text": full_text,
+                "publisher": publisher
+            }],
+            "comments": [] # Initialize empty comments array for this clause
+        }
+
+    def _new_version(self, full_text, publisher_id, publisher_name):
+        return {
+            "date": datetime.now().isoformat(),
+            "full_text": full_text,
+            "publisher_id": publisher_id,
+            "publisher_name": publisher_name
+        }
+
     def open_contract(self, contract_id):
-        contract_path = self._get_contract_path(contract_id)
-        if not os.path.exists(contract_path):
-            return None
-        
-        try:
-            with self.lock, open(contract_path, "r") as f: # Lock applied to reads
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            return None
+        """Return a contract, served from the cache when unchanged on disk. The result is shared and must not be modified."""
+        with self.locks.read(contract_id): # Readers of the same contract don't block each other
+            return self.store.read(contract_id, use_cache=True)
 
     def save_contract(self, contract):
-        contract_path = self._get_contract_path(contract["metadata"]["contract_id"])
-        with self.lock:
-            with open(contract_path, "w") as f: # Lock applied to writes
-                json.dump(contract, f, indent=4)
+        """Save a contract. It is cached as-is afterwards, so it must not be modified once saved.
+        Raises InvalidContract if it doesn't fit the contract schema (see codec.py)."""
+        validate_contract(contract)
+        with self.locks.write(contract["metadata"]["contract_id"]):
+            self.store.write(contract)
+            self.index.update(contract)
                 
     def sanitize_filename(self, title):
         '''Remove special characters to make a safe filename'''
         return re.sub(r'[^\w\s-]', '', title).strip().replace(' ', '_')
     
+    def docx_artifact_id(self, contract):
+        '''Name of a contract's DOCX export: the contract id plus a hash of everything the document shows'''
+        metadata = contract["metadata"]
+        content = [self.DOCX_FORMAT, metadata["title"], metadata["creator_name"], metadata["creation_date"], metadata["status"],
+                   metadata["description"], [[clause["short_title"], clause["versions"][0]["full_text"]] for clause in contract["clauses"]]]
+        digest = hashlib.sha256(json.dumps(content).encode()).hexdigest()[:32]
+        return f"{metadata['contract_id']}-{digest}"
+
+    def docx_path(self, artifact_id):
+        return os.path.join(self.contract_docx_directory, f"{artifact_id}.docx")
+
+    def remove_docx(self, contract_id, keep=None):
+        '''Delete a contract's exported DOCX files, except keep'''
+        for filename in os.listdir(self.contract_docx_directory):
+            path = os.path.join(self.contract_docx_directory, filename)
+            if filename.startswith(f"{contract_id}-") and filename.endswith(".docx") and path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
     def convert_to_docx(self, contract_id):
-        '''Convert a JSON contract into a DOCX file'''
+        '''Convert a JSON contract into a DOCX file. An unchanged contract reuses the file from its last export.'''
         contract = self.open_contract(contract_id) 
         if not contract:
             return None, "Contract not found"
         
-        doc = Document()
-        metadata = contract["metadata"] 
-        
-        # Use the contract title for the filename
-        safe_title = self.sanitize_filename(metadata["title"])
-        docx_filename = f"{safe_title}.docx"
-        docx_path = os.path.join(self.contract_docx_directory, docx_filename)
+        # Files are named by contract and content, so different contracts with the same title don't collide
+        docx_path = self.docx_path(self.docx_artifact_id(contract))
+        if os.path.exists(docx_path):
+            return docx_path, "DOCX file generated successfully"
         
-        # Format creation date
-        creation_date = metadata["creation_date"].split("T")[0] # Extract YYYY-MM-DD
-        
-        # Title
-        doc.add_heading(metadata["title"], level=1)
-        
-        # Contract Info
-        doc.add_paragraph(f"Created by: {metadata['creator_name']}")
-        doc.add_paragraph(f"Creation Date: {creation_date}")
-        doc.add_paragraph(f"Status: {metadata['status']}")
-        doc.add_paragraph(f"Description: {metadata['description']}\n")
-        
-        # Clauses
-        # Clause numbering
-        clause_number = 1
-        for clause in contract["clauses"]:
-            doc.add_heading(f"{clause_number}.{clause['short_title']}", level = 3)
-            
-            # Get latest version of the clause
-            latest_version = clause["versions"][0]
-            clause_text = latest_version["full_text"]
-            
-            # Sentence-level numbering
-            sentence_number = 1
-            for sentence in clause_text.split("\n"):
-                sentence = sentence.strip()
-                if sentence:
-                    doc.add_paragraph(f"{clause_number}.{sentence_number} {sentence}")
-                    sentence_number += 1
-                
-            clause_number += 1 # Increment for the next clause
-            
-        doc.save(docx_path)
+        render_docx(contract, docx_path)
+        self.remove_docx(contract_id, keep=docx_path) # exports of earlier content
         
         return docx_path, "DOCX file generated successfully"
                 
         
         
 
-    def add_clause(self, contract_id, short_title, full_text, publisher):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return None
+    def edit(self, contract_id, user_id=None):
+        """Unit of work for one request: `with core.edit(contract_id, user_id) as edit:` loads and write-locks the
+        contract once, resolves the user's role from that copy and commits every change made through it in one
+        write (see ContractEdit)."""
+        return ContractEdit(self, contract_id, user_id)
 
-        clause_id = self._generate_id()
-        new_clause = {
-            "clause_id": clause_id,
-            "short_title": short_title,
-            "versions": [{
-                "date": datetime.now().isoformat(),
-                "full_text": full_text,
-                "publisher": publisher
-            }],
-            "comments": [] # Initialize empty comments array for this clause
-        }
-        contract["clauses"].append(new_clause)
-        self.save_contract(contract)
-        return new_clause
+    def add_clause(self, contract_id, short_title, full_text, publisher):
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return None
+            return edit.add_clause(short_title, full_text, publisher)
 
     def update_clause(self, contract_id, clause_id, full_text, publisher_id, publisher_name, short_title=None):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False
+            return edit.update_clause(clause_id, full_text, publisher_id, publisher_name, short_title)
 
-        for clause in contract["clauses"]:
-            if clause["clause_id"] == clause_id:
-                # Update the clause text
-                clause["versions"].insert(0, {
-                    "date": datetime.now().isoformat(),
-                    "full_text": full_text,
-                    "publisher_id": publisher_id,
-                    "publisher_name": publisher_name
-                })
-                
-                # Allow renaming if a short_tile is provided
-                if short_title:
-                    clause["short_title"] = short_title
-                    
-                self.save_contract(contract)
-                return True
-        return False
+    def _clause_operation_record(self, contract, operation, user_id, publisher_name):
+        """Validate one batch operation against the contract's current state.
+        Returns (record, result) on success, or (None, error message)."""
+        kind = operation.get("op")
+
+        if kind == "add":
+            if not operation.get("short_title") or "full_text" not in operation:
+                return None, "add needs short_title and full_text"
+            clause = self._new_clause(operation["short_title"], operation["full_text"], user_id)
+            return {"op": "add_clause", "clause": clause}, {"clause_id": clause["clause_id"]}
+
+        if kind not in ("update", "delete", "move"):
+            return None, "op must be one of: add, update, delete, move"
+        if not isinstance(operation.get("clause_id"), str) or not find_clause(contract, operation["clause_id"]):
+            return None, "Clause not found"
+        clause_id = operation["clause_id"]
+
+        if kind == "update":
+            if "full_text" not in operation:
+                return None, "update needs full_text"
+            version = self._new_version(operation["full_text"], user_id, publisher_name)
+            return {"op": "update_clause", "clause_id": clause_id, "version": version,
+                    "short_title": operation.get("short_title")}, {"clause_id": clause_id}
+        if kind == "delete":
+            return {"op": "delete_clause", "clause_id": clause_id}, {"clause_id": clause_id}
+        if not isinstance(operation.get("new_index"), int):
+            return None, "move needs an integer new_index"
+        return {"op": "move_clause", "clause_id": clause_id, "index": operation["new_index"]}, {"clause_id": clause_id}
+
+    def apply_clause_operations(self, contract_id, user_id, operations):
+        """
+        Apply a list of clause operations with one permission check, one load and one save.
+        Each operation is {"op": "add", "short_title", "full_text"}, {"op": "update", "clause_id", "full_text", "short_title" (optional)},
+        {"op": "delete", "clause_id"} or {"op": "move", "clause_id", "new_index"}, applied in order.
+        All or nothing: if one fails, nothing is saved.
+        Returns (success, message, results), with one result per operation, or results=None if the contract
+        doesn't exist or the user may not edit it.
+        """
+        with self.edit(contract_id, user_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found", None
+
+            # Only the creator or editors can change clauses
+            if not edit.can_edit:
+                return False, "Permission denied. Only creator or editors can change clauses", None
+            contract, publisher_name = edit.contract, edit.user_name
+
+            results = []
+            for index, operation in enumerate(operations):
+                record, outcome = self._clause_operation_record(contract, operation, user_id, publisher_name)
+                if record is None:
+                    results.append({"index": index, "success": False, "error": outcome})
+                    results.extend({"index": skipped, "success": False, "error": "Not applied: an earlier operation failed"}
+                                   for skipped in range(index + 1, len(operations)))
+                    edit.discard()
+                    return False, f"Operation {index} failed: {outcome}", results
+                # Stage in memory so later operations see the effect of earlier ones
+                edit.stage(record)
+                results.append({"index": index, "success": True, **outcome})
+
+            return True, f"{len(edit.records)} operations applied", results
     
 
     def check_user_permission(self, contract_id, user_id, required_role=None):
@@ -195,21 +363,15 @@ class Core:
         if not contract:
             return False
         
-        if contract["metadata"]["creator_id"] == user_id:
+        role = contract_role(contract, user_id)
+        if role == "Creator":
             return True
         
         if required_role:
-            for collaborator in contract["metadata"]["collaborators"]:
-                if collaborator["user_id"] == user_id and collaborator["role"] == required_role:
-                    return True
-            return False
+            return role == required_role
         
         # Check if user is a collaborator
-        for collaborator in contract["metadata"]["collaborators"]:
-            if collaborator["user_id"] == user_id:
-                return True
-            
-        return False
+        return role is not None
         
     
     def add_collaborator(self, contract_id, collaborator_data, role, added_by):
@@ -218,161 +380,146 @@ class Core:
         Roles: "Editor", "Viewer:, "Approver"
         Collaborator_data should include user_id, name and email
         """
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
-        
-        # Check if user adding collaborator is the creator
-        if contract["metadata"]["creator_id"] != added_by:
-            return False, "Only the creator can add collaborators"
-
-        # Check if collaborator already exixts
-        for collab in contract["metadata"]["collaborators"]:
-            if collab["user_id"] == collaborator_data["user_id"]:
-                return False, "Collaborator already exists"
-        
-        # Validate role
-        valid_roles = ["Editor", "Viewer", "Approver"]
-        if role not in valid_roles:
-            return False, "Role must be specified"
-        
-        # Add collaborator with role
-        new_collaborator = {
-            "user_id": collaborator_data["user_id"],
-            "name": collaborator_data["name"],
-            "email": collaborator_data["email"],
-            "role": role,
-            "added_date": datetime.now().isoformat()
-        }
-        
-        contract["metadata"]["collaborators"].append(new_collaborator)
-        self.save_contract(contract)
-        return True, "Collaborator added successfully"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.add_collaborator(collaborator_data, role, added_by)
 
     def remove_collaborator(self, contract_id, collaborator_id, removed_by):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False
-        
-        # Check if user removing collaborator is the creator
-        if contract["metadata"]["creator_id"] != removed_by:
-            return False, "Only the contract creator can remove collaborators"
-
-        # Find and remove collaborator
-        for i, collab in enumerate(contract["metadata"]["collaborators"]):
-            if collab["user_id"] == collaborator_id:
-                contract["metadata"]["collaborators"].pop(i)
-                self.save_contract(contract)
-                return True, "Collaborator removed successfully"
-            
-        return False, "Collaborator not found"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.remove_collaborator(collaborator_id, removed_by)
     
     def update_role(self, contract_id, collaborator_id, new_role, requester_id):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
-        
-        # Only the contract creator can update roles
-        if contract['metadata']['creator_id'] != requester_id:
-            return False, "Only the contract creator can update roles"
-        
-        # Find collaborators and uodate role
-        for collab in contract['metadata']['collaborators']:
-            if collab['user_id'] == collaborator_id:
-                collab['role'] = new_role
-                self.save_contract(contract)
-                return True, "Role updated successfully"
-        return False, "Collaborator not found"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.update_role(collaborator_id, new_role, requester_id)
+
+    def resolve_fields(self, view=None, fields=None):
+        """Turn a view name or a comma-separated fields list (which wins) into the set of contract parts to return.
+        Raises ValueError for unknown names."""
+        if fields:
+            requested = {field.strip() for field in fields.split(",") if field.strip()}
+            unknown = requested.difference(self.CONTRACT_FIELDS)
+            if unknown:
+                raise ValueError(f"Invalid fields: {', '.join(sorted(unknown))}. Must be among: {', '.join(self.CONTRACT_FIELDS)}")
+            return requested
+        view = view or "full"
+        if view not in self.CONTRACT_VIEWS:
+            raise ValueError(f"Invalid view. Must be one of: {', '.join(self.CONTRACT_VIEWS)}")
+        return set(self.CONTRACT_VIEWS[view])
+
+    def _project_clause(self, clause, fields):
+        """Copy of a clause with only the requested parts. Older versions are only rebuilt (see versions.py) when asked for."""
+        projected = {key: value for key, value in clause.items() if key not in ("versions", "comments")}
+        projected["versions"] = expand_versions(clause["versions"]) if "history" in fields else clause["versions"][:1]
+        if "comments" in fields:
+            projected["comments"] = clause.get("comments", [])
+        return projected
+
+    def project_contract(self, contract, fields=None):
+        """Copy of a contract with only the requested parts (see resolve_fields), as clients see it. Defaults to all of it."""
+        if fields is None:
+            fields = self.resolve_fields()
+        projected = {}
+        if "metadata" in fields:
+            projected["metadata"] = contract["metadata"]
+        if not fields.isdisjoint(("clauses", "history", "comments")):
+            projected["clauses"] = [self._project_clause(clause, fields) for clause in contract["clauses"]]
+        return projected
 
     # Get all clauses
-    def get_clauses(self, contract_id):
+    def get_clauses(self, contract_id, fields=None):
         contract = self.open_contract(contract_id)
         if not contract:
             return False
+        if fields is None:
+            fields = self.resolve_fields()
 
         if "clauses" in contract:
-            return contract["clauses"]
+            return [self._project_clause(clause, fields) for clause in contract["clauses"]]
         
         return None
+
+    def get_clause_version(self, contract_id, clause_id, number):
+        """Return version number (0 is the latest) of a clause with its full text, or None if any of them doesn't exist."""
+        contract = self.open_contract(contract_id)
+        if not contract:
+            return None
+        clause = find_clause(contract, clause_id)
+        if not clause or not 0 <= number < len(clause["versions"]):
+            return None
+        version = {key: value for key, value in clause["versions"][number].items() if key != "delta"}
+        version["full_text"] = version_text(clause["versions"], number)
+        return version
         
          
         
     def delete_clause(self, contract_id, clause_id):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False
-        
-        contract["clauses"] = [clause for clause in contract["clauses"] if clause["clause_id"] != clause_id]
-        self.save_contract(contract)
-        return True
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False
+            return edit.delete_clause(clause_id)
 
     def delete_contract(self, contract_id):
-        contract_path = self._get_contract_path(contract_id)
-        if os.path.exists(contract_path):
-            with self.lock:
-                os.remove(contract_path)
-            return True
-        return False
-
-    def list_contracts(self, creator_id=None, collaborator_id=None):
-        contracts = []
-        for filename in os.listdir(self.contract_directory):
-            if filename.endswith(".json"):
-                contract_id = filename[:-5]
-                contract = self.open_contract(contract_id)
-                if contract:
-                    if creator_id and contract["metadata"]["creator_id"] != creator_id:
-                        continue
-                    if collaborator_id and collaborator_id not in contract["metadata"]["collaborators"]:
-                        continue
-                    contracts.append(contract["metadata"])
-        return contracts
+        with self.locks.write(contract_id):
+            return self._delete_contract(contract_id)
+
+    def _delete_contract(self, contract_id):
+        """Callers must hold the contract's write lock."""
+        self.index.remove(contract_id)
+        self.remove_docx(contract_id)
+        return self.store.delete(contract_id)
+
+    def list_contracts(self, creator_id=None, collaborator_id=None, status=None, title=None, created_after=None,
+                       created_before=None, sort="creation_date", descending=True, limit=50, cursor=None):
+        """
+        List contract metadata from the index, one page at a time, without opening any contract.
+        Returns the contracts and the cursor for the next page (None on the last page).
+        Raises ValueError for an invalid sort or cursor.
+        """
+        return self.index.query(
+            creator_id=creator_id,
+            collaborator_id=collaborator_id,
+            status=status,
+            title=title,
+            created_after=created_after,
+            created_before=created_before,
+            sort=sort,
+            descending=descending,
+            limit=limit,
+            cursor=cursor
+        )
+
+    def matching_contract_ids(self, limit, **filters):
+        """Ids of up to limit contracts matching list_contracts filters (creator_id, collaborator_id, status, ...), oldest first."""
+        contract_ids, cursor = [], None
+        while len(contract_ids) < limit:
+            page, cursor = self.index.query(descending=False, limit=min(200, limit - len(contract_ids)), cursor=cursor, **filters)
+            contract_ids.extend(contract["contract_id"] for contract in page)
+            if not cursor:
+                break
+        return contract_ids
     
+    def search_clauses(self, user_id, query, include_comments=False, limit=20, offset=0):
+        """
+        Full-text search over the titles and latest text (and optionally comments) of clauses in contracts
+        the user created or collaborates on. Returns the best matches first, with highlighted snippets.
+        Raises ValueError if the query has no words to search for.
+        """
+        return self.index.search(user_id, query, include_comments=include_comments, limit=limit, offset=offset)
+
     def add_comment(self, contract_id, clause_id, user_id, email, name, comment_text):
         """
         Add a comment to a specific clause in a contract.
         Any user with access to the contract can comment.
         """
-            
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
-            
-            # Check if user has access
-        has_access = False
-        if contract["metadata"]["creator_id"] == user_id:
-            has_access = True
-        else:
-            for collab in contract["metadata"]["collaborators"]:
-                if collab["user_id"] == user_id:
-                    has_access = True
-                    break
-                    
-        if not has_access:
-            return False, "User does not have access to this contract"
-            
-        # Find the clause
-        for clause in contract["clauses"]:
-            if clause["clause_id"] == clause_id:
-                # Initialize comments array if it doesn't exist
-                if "comments" not in clause:
-                    clause["comments"] = []
-                        
-                # Add the comment
-                comment_id = self._generate_id()
-                new_comment = {
-                        "comment_id": comment_id,
-                        "user_id": user_id,
-                        "email": email,
-                        "name": name,
-                        "comment": comment_text,
-                        "date": datetime.now().isoformat()
-                    }
-                    
-                clause["comments"].append(new_comment)
-                self.save_contract(contract)
-                return True, comment_id
-        return False, "Clause not found"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.add_comment(clause_id, user_id, email, name, comment_text)
     
     def get_comments(self, contract_id, clause_id):
         """
@@ -382,11 +529,9 @@ class Core:
         if not contract:
             return None
         
-        for clause in contract["clauses"]:
-            if clause["clause_id"] == clause_id:
-                if "comments" in clause:
-                    return clause["comments"]
-                return []
+        clause = find_clause(contract, clause_id)
+        if clause:
+            return clause.get("comments", [])
         
         return None
     
@@ -394,98 +539,190 @@ class Core:
         """
         Delete a comment. Only the comment creator or contract creator can delete.
         """
-        
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
-        
-        for clause in contract["clauses"]:
-            if clause["clause_id"] == clause_id and "comments" in clause:
-                for i, comment in enumerate(clause["comments"]):
-                    if comment["comment_id"] == comment_id:
-                        # Check if user is authorized to delete
-                        if comment['user_id'] == user_id or contract["metadata"]["creator_id"] == user_id:
-                            clause["comments"].pop(i)
-                            self.save_contract(contract)
-                            return True, "Comment deleted successfully"
-                        else: 
-                            return False, "Not authorized to delete this comment"
-                return False, "Comment not found"
-        return False, "Clause not found"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.delete_comment(clause_id, comment_id, user_id)
     
     def move_clause(self, contract_id, clause_id, new_index):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
-        
-        clauses = contract["clauses"]
-        
-        # Find the clause to move
-        clause_to_move = next((clause for clause in clauses if clause["clause_id"] == clause_id), None)
-        if not clause_to_move:
-            return False, "Clause not found"
-        
-        # Remove it from its current position
-        clauses.remove(clause_to_move)
-        
-        # Insert it into the new position
-        if new_index < 0 or new_index >= len(clauses):
-            clauses.append(clause_to_move) # Move to end if index is out of bounds
-        else: 
-            clauses.insert(new_index, clause_to_move)
-        
-        # Save updated contract
-        self.save_contract(contract)
-        return True, "Clause moved successfully"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.move_clause(clause_id, new_index)
     
     def approve_contract(self, contract_id, user_id):
-        contract = self.open_contract(contract_id)
-        if not contract:
-            return False, "Contract not found"
-
-        # Only Approvers can approve the contract
-        has_permission = any(
-            collab["user_id"] == user_id and collab['role'] == 'Approver'
-            for collab in contract['metadata']['collaborators']
-        )      
-        if not has_permission:
-            return False, "Only Approvers can approve the contract" 
-        
-        # Change status to Approved
-        contract['metadata']['status'] = 'Approved'
-        self.save_contract(contract)
-        
-        return True, "Contract approved successfully"
+        with self.edit(contract_id) as edit:
+            if not edit.contract:
+                return False, "Contract not found"
+            return edit.approve(user_id)
     
     def explain_clause(self, clause_text):
-        """Use OpenAI API to explain a contract clause in simple terms."""
+        """Use the AI model to explain a contract clause in simple terms. Explanations are cached by model, prompt and text.
+        Raises LLMUnavailable when the model can't be reached."""
         
         # prompt = f"{clause_text}"
+        cache_key = ExplanationCache.key(EXPLAIN_MODEL, EXPLAIN_PROMPT, clause_text)
+        explanation = self.explanations.get(cache_key)
+        if explanation is not None:
+            return explanation
+        
+        explanation = self.llm.complete(EXPLAIN_MODEL, [{"role": "system", "content": EXPLAIN_PROMPT},
+                                                        {"role": "user", "content": f"{clause_text}"}])
+        self.explanations.put(cache_key, explanation)
+        return explanation
+
+    def explain_contract(self, contract, parallelism=4):
+        """Explain every clause of a contract, at most parallelism at a time, then summarize the whole contract.
+        Yields ("clause", {"clause_id", "short_title", "explanation" or "error"}) as each clause is done, in completion
+        order, then ("summary", {"summary" or "error", "explained", "failed"}). Cached explanations come back at once,
+        and clauses with identical text are only explained once."""
+        clauses_by_text = {}
+        for clause in contract["clauses"]:
+            clauses_by_text.setdefault(clause["versions"][0]["full_text"], []).append(clause)
         
-        response = client.chat.completions.create(
-            model ="gpt-4",
-            messages=[{"role": "system", "content": "You are a legal AI assistant that explains contract clauses. Explain the provided clause from a contract in a simple and clear way, in not more than 200 words:"},
-                      {"role": "user", "content": f"{clause_text}"}]
-        )
-        
-        return response.choices[0].message.content.strip()
-    
-    def ask_clause_question(self, clause_text, conversation_history, user_question):
-        """Use OpenAI API to answer questions related to a specific clause with context."""
+        explanations = {} # clause_id -> explanation
+        failed = 0
+        remaining = iter(clauses_by_text)
+        running = {} # future -> clause text
+        try:
+            while True:
+                while len(running) < parallelism:
+                    clause_text = next(remaining, None)
+                    if clause_text is None:
+                        break
+                    running[self._explain_pool.submit(self.explain_clause, clause_text)] = clause_text
+                if not running:
+                    break
+                
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    clause_text = running.pop(future)
+                    try:
+                        result = {"explanation": future.result()}
+                    except LLMUnavailable as e:
+                        result = {"error": str(e)}
+                    except Exception as e:
+                        print(f"Error explaining clause: {e}")
+                        result = {"error": "Explanation failed"}
+                    for clause in clauses_by_text[clause_text]:
+                        if "explanation" in result:
+                            explanations[clause["clause_id"]] = result["explanation"]
+                        else:
+                            failed += 1
+                        yield "clause", dict(result, clause_id=clause["clause_id"], short_title=clause["short_title"])
+        finally:
+            for future in running:
+                future.cancel() # the caller stopped listening
+        
+        summary = {"explained": len(explanations), "failed": failed}
+        if explanations:
+            try:
+                summary["summary"] = self._summarize_contract(contract, explanations)
+            except LLMUnavailable as e:
+                summary["error"] = str(e)
+            except Exception as e:
+                print(f"Error summarizing contract: {e}")
+                summary["error"] = "Summary failed"
+        yield "summary", summary
+
+    def _summarize_contract(self, contract, explanations):
+        """Combine clause explanations, in contract order, into one summary. Cached like explanations."""
+        text = "\n\n".join(f"{clause['short_title']}: {explanations[clause['clause_id']]}"
+                             for clause in contract["clauses"] if clause["clause_id"] in explanations)
+        cache_key = ExplanationCache.key(EXPLAIN_MODEL, CONTRACT_SUMMARY_PROMPT, text)
+        summary = self.explanations.get(cache_key)
+        if summary is None:
+            summary = self.llm.complete(EXPLAIN_MODEL, [{"role": "system", "content": CONTRACT_SUMMARY_PROMPT},
+                                                        {"role": "user", "content": text}])
+            self.explanations.put(cache_key, summary)
+        return summary
+
+    def stream_clause_explanation(self, clause_text):
+        """Like explain_clause, but yields the explanation in pieces as they arrive. A cached one comes in one piece."""
+        cache_key = ExplanationCache.key(EXPLAIN_MODEL, EXPLAIN_PROMPT, clause_text)
+        explanation = self.explanations.get(cache_key)
+        if explanation is not None:
+            yield explanation
+            return
+        
+        parts = []
+        for part in self.llm.stream(EXPLAIN_MODEL, [{"role": "system", "content": EXPLAIN_PROMPT},
+                                                    {"role": "user", "content": f"{clause_text}"}]):
+            parts.append(part)
+            yield part
+        # Only reached when the whole explanation arrived, so partial ones are never cached
+        self.explanations.put(cache_key, "".join(parts).strip())
+
+    def clause_conversation(self, owner, contract_id, clause_id):
+        """Return the summary of a conversation's older turns (or None) and the messages since, as [{"role", "content"}, ...]."""
+        summary, summarized_through = self.conversations.summary(owner, contract_id, clause_id)
+        messages = self.conversations.history(owner, contract_id, clause_id, after=summarized_through)
+        return summary, [{"role": message["role"], "content": message["content"]} for message in messages]
+
+    def _summarize(self, summary, messages):
+        """Fold messages into the running summary of a conversation."""
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if summary:
+            transcript = f"Summary so far: {summary}\n{transcript}"
+        return self.llm.complete(QUESTION_MODEL, [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}])
+
+    def _conversation_window(self, owner, contract_id, clause_id):
+        """The summary and the most recent messages of a conversation that fit in HISTORY_TOKEN_BUDGET.
+        Once the messages overflow the budget, all but the last half budget's worth are folded into the stored
+        summary, so they are never loaded again and summarizing only happens every few turns."""
+        summary, summarized_through = self.conversations.summary(owner, contract_id, clause_id)
+        messages = self.conversations.history(owner, contract_id, clause_id, after=summarized_through)
+        
+        def recent_start(budget):
+            tokens = 0
+            start = len(messages)
+            while start > 0 and tokens + estimate_tokens(messages[start - 1]["content"]) <= budget:
+                start -= 1
+                tokens += estimate_tokens(messages[start]["content"])
+            return start
+        
+        start = recent_start(HISTORY_TOKEN_BUDGET)
+        if start > 0:
+            start = recent_start(HISTORY_TOKEN_BUDGET // 2)
+        older, recent = messages[:start], messages[start:]
+        if older:
+            try:
+                summary = self._summarize(summary, older)
+                self.conversations.set_summary(owner, contract_id, clause_id, summary, older[-1]["message_id"])
+            except LLMUnavailable:
+                pass # answer without those turns this time and summarize them on a later question
+        return summary, [{"role": message["role"], "content": message["content"]} for message in recent]
+
+    def _question_messages(self, clause_text, summary, recent_messages, user_question):
         messages = [
-            {"role": "system", "content": "You are a legal AI assistant that answers user questions in not more than 200 words, based on contract clauses."},
+            {"role": "system", "content": QUESTION_PROMPT},
             {"role": "assistant", "content": f"Clause: {clause_text}"},
         ]
         
-        # Add conversation history
-        messages.extend(conversation_history)
+        # Add conversation history: a summary of older turns, then the recent ones
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        messages.extend(recent_messages)
         # Add new question from user
         messages.append({"role": "user", "content": user_question})
-        
-        response = client.chat.completions.create(
-            model = "gpt-4",
-            messages =messages
-        )
-        
-        return response.choices[0].message.content.strip()
+        return messages
+    
+    def ask_clause_question(self, owner, contract_id, clause_id, clause_text, user_question):
+        """Use the AI model to answer a question about a clause, in the context of owner's conversation about it.
+        The question and answer are added to the conversation. Raises LLMUnavailable when the model can't be reached."""
+        summary, recent_messages = self._conversation_window(owner, contract_id, clause_id)
+        answer = self.llm.complete(QUESTION_MODEL, self._question_messages(clause_text, summary, recent_messages, user_question))
+        self.conversations.append(owner, contract_id, clause_id,
+                                  [{"role": "user", "content": user_question}, {"role": "assistant", "content": answer}])
+        return answer
+
+    def stream_clause_question(self, owner, contract_id, clause_id, clause_text, user_question):
+        """Like ask_clause_question, but yields the answer in pieces as they arrive. Only complete answers are recorded."""
+        summary, recent_messages = self._conversation_window(owner, contract_id, clause_id)
+        parts = []
+        for part in self.llm.stream(QUESTION_MODEL, self._question_messages(clause_text, summary, recent_messages, user_question)):
+            parts.append(part)
+            yield part
+        self.conversations.append(owner, contract_id, clause_id,
+                                  [{"role": "user", "content": user_question}, {"role": "assistant", "content": "".join(parts).strip()}])
                      
\ No newline at end of file
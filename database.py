@@ -3,13 +3,41 @@ import random
 import json
 from datetime import datetime, timedelta
 import hashlib
+import threading
+from connections import ConnectionPool
+from cache import TTLCache
+
+_migrated = set() # database paths this process has already migrated
+_migration_lock = threading.Lock()
 
 class Database:
     def __init__(self):
         self.db_path = '../datastore.db'
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor() 
-        
+        # Pooled WAL-mode connections, reused across requests instead of reconnecting for every query
+        self.pool = ConnectionPool(self.db_path)
+        # Profiles from Caserover's users table, keyed by ("user_id", id) and ("email", email).
+        # Caserover can change them behind our back, so entries expire after a minute.
+        self.profile_cache = TTLCache(ttl=60, max_entries=10000)
+        self.migrate()
+
+    def migrate(self):
+        '''Apply pending schema migrations. Applied migrations are recorded in contracts_schema_migrations, a table
+        of our own: datastore.db is Caserover's database, so its PRAGMA user_version isn't ours to use. Each process
+        only checks once, so constructing more Database objects costs nothing.'''
+        with _migration_lock:
+            if self.db_path in _migrated:
+                return
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE') # take the write lock so concurrent workers migrate one at a time
+                conn.execute('CREATE TABLE IF NOT EXISTS contracts_schema_migrations (version INTEGER PRIMARY KEY)')
+                version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM contracts_schema_migrations').fetchone()[0]
+                for number, migration in enumerate(self.MIGRATIONS, start=1):
+                    if number > version:
+                        migration(self, conn.cursor())
+                        conn.execute('INSERT INTO contracts_schema_migrations (version) VALUES (?)', (number,))
+            _migrated.add(self.db_path)
+
+    def _create_tables(self, cursor):
         # Use Caserover's users table in datastore.db
 
         # Create Contracts table
@@ -23,26 +51,84 @@ class Database:
         # cursor.execute('''CREATE TABLE IF NOT EXISTS invitations
         #                         (invitation_id TEXT, contract_id TEXT, email TEXT, role TEXT, status TEXT, created_at TEXT)''')
 
-        conn.commit()
-        conn.close()
+    def _add_keys_and_indexes(self, cursor):
+        '''Rebuild contracts and permissions with primary keys, dropping duplicate rows (the latest row wins).'''
+        cursor.execute('''CREATE TABLE contracts_new
+                                (contract_id TEXT PRIMARY KEY, title TEXT, creator_id TEXT, status TEXT, created_at TEXT)''')
+        cursor.execute('''INSERT OR REPLACE INTO contracts_new (contract_id, title, creator_id, status, created_at)
+                          SELECT contract_id, title, creator_id, status, created_at FROM contracts
+                          WHERE contract_id IS NOT NULL ORDER BY rowid''')
+        cursor.execute('DROP TABLE contracts')
+        cursor.execute('ALTER TABLE contracts_new RENAME TO contracts')
+        # Covers get_user_contracts without touching the table
+        cursor.execute('CREATE INDEX idx_contracts_creator ON contracts (creator_id, contract_id, title, status)')
+
+        cursor.execute('''CREATE TABLE permissions_new
+                                (contract_id TEXT NOT NULL, user_id TEXT NOT NULL, role TEXT, PRIMARY KEY (contract_id, user_id))''')
+        cursor.execute('''INSERT OR REPLACE INTO permissions_new (contract_id, user_id, role)
+                          SELECT contract_id, user_id, role FROM permissions
+                          WHERE contract_id IS NOT NULL AND user_id IS NOT NULL ORDER BY rowid''')
+        cursor.execute('DROP TABLE permissions')
+        cursor.execute('ALTER TABLE permissions_new RENAME TO permissions')
+        # Covers get_user_collaborations, update_role and delete_role lookups by user
+        cursor.execute('CREATE INDEX idx_permissions_user ON permissions (user_id, contract_id, role)')
+
+    def _index_user_emails(self, cursor):
+        '''Index Caserover's users table for the lookups by email (user_id is its key).'''
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'")
+        if cursor.fetchone():
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)')
+
+    # Applied in order; a migration's number is its position in the list. Only ever append to it.
+    # Migrations must be safe to re-run: databases migrated while versions were kept in user_version run them again.
+    MIGRATIONS = [_create_tables, _add_keys_and_indexes, _index_user_emails]
+
+    def _profile_from_row(self, user):
+        profile = {
+            "status": "success",
+            "user_id": user[0],
+            "name": user[1],
+            "email": user[2],
+            "phone": user[3],
+            "user_type": user[4],
+            "code": user[5],
+            "user_status": user[7],
+            "next_date": user[8],
+            "isadmin": user[10]
+        }
+        # Add lawfirm name if user type is "org"
+        if user[4] == "org":
+            profile["lawfirm_name"] = user[6]
+        return profile
+
+    def _cache_profile(self, profile):
+        self.profile_cache.put(("user_id", profile["user_id"]), profile)
+        self.profile_cache.put(("email", profile["email"]), profile)
+
+    def invalidate_user(self, user_id=None, email=None):
+        '''Drop a user's cached profile, e.g. after it was changed. Either key is enough.'''
+        for key in (("user_id", user_id), ("email", email)):
+            profile = self.profile_cache.invalidate(key) if key[1] else None
+            if profile:
+                # Also drop the entry under the profile's other key
+                self.profile_cache.invalidate(("user_id", profile["user_id"]))
+                self.profile_cache.invalidate(("email", profile["email"]))
 
     # Get a user's profile based on the user_id
     def user_profile(self, user_id):
         '''Fetch user profile from the database.'''
+        profile = self.profile_cache.get(("user_id", user_id))
+        if profile:
+            return dict(profile)
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
                 user = cursor.fetchone()
                 if user:
-                    # Base response
-                    response = { "status": "success", "name": user[1], "email": user[2], "phone": user[3], "user_type": user[4], "code": user[5], "user_status": user[7], "next_date": user[8], "isadmin": user[10]}
-
-                    # Add lawfirm name if user type is "org"
-                    if user[4] == "org":
-                        response["lawfirm_name"] = user[6]
-                    
-                    return response
+                    profile = self._profile_from_row(user)
+                    self._cache_profile(profile)
+                    return dict(profile)
                 else:
                     return {"status": "User does not exist"}
         except Exception as e:
@@ -52,40 +138,38 @@ class Database:
             # Get a user's profile based on email
     def get_user_by_email(self, email):
         '''Fetch user profile from the database using email address.'''
+        profile = self.profile_cache.get(("email", email))
+        if profile:
+            return dict(profile)
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM users WHERE email=?', (email,))
                 user = cursor.fetchone()
                 if user:
-                    # Return user info
-                    response = {
-                        "status": "success",
-                        "user_id": user[0],
-                        "name": user[1],
-                        "email": user[2],
-                        "phone": user[3],
-                        "user_type": user[4],
-                        "code": user[5],
-                        "user_status": user[7],
-                        "next_date": user[8],
-                        "isadmin": user[10]
-                    }
-                    
-                    # Add lawfirm name if user type is "org"
-                    if user[4] == "org":
-                        response["lawfirm_name"] = user[6]
-                    return response
+                    profile = self._profile_from_row(user)
+                    self._cache_profile(profile)
+                    return dict(profile)
                 else:
                     return {"status": "User does not exist"}
         except Exception as e:
             print("Error on loading profile by email: " + str(e))
             return {"status": "Error: " + str(e)}
+
+    def find_user_by_email(self, email):
+        '''Return the profile for an email, or None if no user has it. One (usually cached) lookup
+        instead of email_exists followed by get_user_by_email.'''
+        profile = self.get_user_by_email(email)
+        if profile.get("status") != "success":
+            return None
+        return profile
         
     # Check if a user exists in the database by user_id
     def user_exists(self, user_id):
+        if self.profile_cache.get(("user_id", user_id)):
+            return True
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT user_id FROM users WHERE user_id=?', (user_id,))
                 user = cursor.fetchone()
@@ -96,8 +180,10 @@ class Database:
     
     # Check if a user exists in the database by email
     def email_exists(self, email):
+        if self.profile_cache.get(("email", email)):
+            return True
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT user_id FROM users WHERE email=?', (email,))
                 user = cursor.fetchone()
@@ -111,7 +197,7 @@ class Database:
         '''Create a new contract in the database.'''
         created_at = datetime.now().isoformat()
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('INSERT INTO contracts (contract_id, title, creator_id, status, created_at) VALUES (?, ?, ?, ?, ?)', 
                                 (contract_id, title, creator_id, status, created_at))
@@ -124,7 +210,7 @@ class Database:
             
     def get_contract(self, contract_id):
         try: 
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM contracts WHERE contract_id = ?', (contract_id,))
                 # Fetch the contract details
@@ -137,9 +223,9 @@ class Database:
     # Add a role (when adding a collaborator)
     def add_role(self, user_id, contract_id, role):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('INSERT INTO permissions (contract_id, user_id, role) VALUES (?, ?, ?)', (contract_id, user_id, role))  
+                cursor.execute('INSERT OR REPLACE INTO permissions (contract_id, user_id, role) VALUES (?, ?, ?)', (contract_id, user_id, role))  
                 conn.commit()
                 return True
         except sqlite3.Error as e:
@@ -149,7 +235,7 @@ class Database:
     # Update a user's role for a contract
     def update_role(self, user_id, contract_id, new_role):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('UPDATE permissions SET role = ? WHERE user_id = ? AND contract_id = ?', (new_role, user_id, contract_id))
                 conn.commit()
@@ -161,7 +247,7 @@ class Database:
     # Delete a role (when removing a collaborator)
     def delete_role(self, user_id, contract_id):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM permissions WHERE user_id = ? AND contract_id = ?', (user_id, contract_id))
                 conn.commit()
@@ -173,7 +259,7 @@ class Database:
     # Delete a contract
     def delete_contract(self, contract_id):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 
                 # Delete contract from contracts table
@@ -190,7 +276,7 @@ class Database:
         
    # Get all contracts a user owns
     def get_user_contracts(self, user_id):
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
             SELECT contract_id, title, status FROM contracts WHERE creator_id = ?
@@ -200,7 +286,7 @@ class Database:
     # Get all contracts a user is a collaborator on, along with their role
     def get_user_collaborations(self, user_id):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                 SELECT p.contract_id, c.title, p.role
@@ -218,7 +304,7 @@ class Database:
         
     def update_contract_status(self, contract_id, new_status):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('UPDATE contracts SET status = ? WHERE contract_id = ?', (new_status, contract_id))
                 conn.commit()
@@ -0,0 +1,188 @@
+from datetime import datetime
+from model import contract_role, find_clause, find_collaborator
+
+
+class ContractEdit:
+    """One request's changes to a contract: loaded and write-locked once, changed in memory, committed once.
+
+        with contract_manager.edit(contract_id, user_id) as edit:
+            if not edit.contract: ...         # not found
+            if not edit.can_edit: ...         # role resolved from the loaded copy
+            edit.update_clause(...)
+            edit.move_clause(...)
+
+    Each change is validated against the in-memory contract and staged as an operation record (see operations.py).
+    Leaving the block commits all staged records in one write, still under the lock, so nothing can change the
+    contract between the permission check and the save. If the block raises, or discard() was called, nothing is saved.
+    """
+
+    EDIT_ROLES = ("Creator", "Editor")
+
+    def __init__(self, core, contract_id, user_id=None):
+        self.core = core
+        self.contract_id = contract_id
+        self.user_id = user_id
+        self.contract = None
+        self.records = []
+        self._lock = core.locks.write(contract_id)
+
+    def __enter__(self):
+        self._lock.__enter__()
+        try:
+            self.contract = self.core._read_contract(self.contract_id)
+        except BaseException:
+            self._lock.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None and self.records and self.contract:
+                self.core._commit(self.contract, self.records)
+        finally:
+            self.records = []
+            self._lock.__exit__(exc_type, exc, traceback)
+        return False
+
+    def discard(self):
+        """Drop every change staged so far. The in-memory contract keeps them, so stop using it."""
+        self.records = []
+        self.contract = None
+
+    def stage(self, record):
+        """Apply an operation record to the in-memory contract, to be committed with the rest."""
+        self.core._stage(self.contract, record)
+        self.records.append(record)
+
+    def _clause(self, clause_id):
+        return find_clause(self.contract, clause_id)
+
+    def _collaborator(self, user_id):
+        return find_collaborator(self.contract, user_id)
+
+    @property
+    def role(self):
+        """The user's role: "Creator", or their collaborator role, or None without access (or without a contract)."""
+        if not self.contract or self.user_id is None:
+            return None
+        return contract_role(self.contract, self.user_id)
+
+    @property
+    def user_name(self):
+        """The user's name as recorded on the contract, or None."""
+        if self.role == "Creator":
+            return self.contract["metadata"]["creator_name"]
+        collaborator = self._collaborator(self.user_id) if self.role else None
+        return collaborator["name"] if collaborator else None
+
+    @property
+    def can_edit(self):
+        return self.role in self.EDIT_ROLES
+
+    def add_clause(self, short_title, full_text, publisher):
+        clause = self.core._new_clause(short_title, full_text, publisher)
+        self.stage({"op": "add_clause", "clause": clause})
+        return clause
+
+    def update_clause(self, clause_id, full_text, publisher_id, publisher_name, short_title=None):
+        if not self._clause(clause_id):
+            return False
+        # Update the clause text, allowing renaming if a short_title is provided
+        self.stage({
+            "op": "update_clause",
+            "clause_id": clause_id,
+            "version": self.core._new_version(full_text, publisher_id, publisher_name),
+            "short_title": short_title
+        })
+        return True
+
+    def delete_clause(self, clause_id):
+        self.stage({"op": "delete_clause", "clause_id": clause_id})
+        return True
+
+    def move_clause(self, clause_id, new_index):
+        if not self._clause(clause_id):
+            return False, "Clause not found"
+        # Move it to the new position (or the end if the index is out of bounds)
+        self.stage({"op": "move_clause", "clause_id": clause_id, "index": new_index})
+        return True, "Clause moved successfully"
+
+    def add_collaborator(self, collaborator_data, role, added_by):
+        # Check if user adding collaborator is the creator
+        if self.contract["metadata"]["creator_id"] != added_by:
+            return False, "Only the creator can add collaborators"
+        if self._collaborator(collaborator_data["user_id"]):
+            return False, "Collaborator already exists"
+        if role not in ["Editor", "Viewer", "Approver"]:
+            return False, "Role must be specified"
+
+        new_collaborator = {
+            "user_id": collaborator_data["user_id"],
+            "name": collaborator_data["name"],
+            "email": collaborator_data["email"],
+            "role": role,
+            "added_date": datetime.now().isoformat()
+        }
+        self.stage({"op": "add_collaborator", "collaborator": new_collaborator})
+        return True, "Collaborator added successfully"
+
+    def remove_collaborator(self, collaborator_id, removed_by):
+        if self.contract["metadata"]["creator_id"] != removed_by:
+            return False, "Only the contract creator can remove collaborators"
+        if not self._collaborator(collaborator_id):
+            return False, "Collaborator not found"
+        self.stage({"op": "remove_collaborator", "user_id": collaborator_id})
+        return True, "Collaborator removed successfully"
+
+    def update_role(self, collaborator_id, new_role, requester_id):
+        if self.contract["metadata"]["creator_id"] != requester_id:
+            return False, "Only the contract creator can update roles"
+        if not self._collaborator(collaborator_id):
+            return False, "Collaborator not found"
+        self.stage({"op": "update_role", "user_id": collaborator_id, "role": new_role})
+        return True, "Role updated successfully"
+
+    def add_comment(self, clause_id, user_id, email, name, comment_text):
+        """Any user with access to the contract can comment. Returns (True, comment_id) or (False, message)."""
+        metadata = self.contract["metadata"]
+        if metadata["creator_id"] != user_id and not self._collaborator(user_id):
+            return False, "User does not have access to this contract"
+        if not self._clause(clause_id):
+            return False, "Clause not found"
+
+        comment = {
+            "comment_id": self.core._generate_id(),
+            "user_id": user_id,
+            "email": email,
+            "name": name,
+            "comment": comment_text,
+            "date": datetime.now().isoformat()
+        }
+        self.stage({"op": "add_comment", "clause_id": clause_id, "comment": comment})
+        return True, comment["comment_id"]
+
+    def delete_comment(self, clause_id, comment_id, user_id):
+        """Only the comment creator or contract creator can delete."""
+        clause = self._clause(clause_id)
+        if not clause or "comments" not in clause:
+            return False, "Clause not found"
+        comment = next((comment for comment in clause["comments"] if comment["comment_id"] == comment_id), None)
+        if not comment:
+            return False, "Comment not found"
+        if comment["user_id"] != user_id and self.contract["metadata"]["creator_id"] != user_id:
+            return False, "Not authorized to delete this comment"
+        self.stage({"op": "delete_comment", "clause_id": clause_id, "comment_id": comment_id})
+        return True, "Comment deleted successfully"
+
+    def approve(self, user_id):
+        # Only Approvers can approve the contract
+        collaborator = self._collaborator(user_id)
+        if not collaborator or collaborator["role"] != "Approver":
+            return False, "Only Approvers can approve the contract"
+        self.stage({"op": "set_status", "status": "Approved"})
+        return True, "Contract approved successfully"
+
+    def delete_contract(self):
+        """Delete the contract right away, along with anything staged. Returns False if it didn't exist."""
+        self.discard()
+        return self.core._delete_contract(self.contract_id)
@@ -0,0 +1,242 @@
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from core import render_docx
+
+_ARTIFACT_ID = re.compile(r'[\w-]+')
+
+
+class ExportJobs:
+    """Runs DOCX exports on a bounded pool of worker threads, so requests don't wait for python-docx.
+
+    A job's id is the artifact id of the content it exports (see Core.docx_artifact_id), so submitting an
+    unchanged contract again returns the finished file straight away, and exports of the same content share a job.
+    Job status is kept in memory for keep_finished seconds; finished files can be found by id from any process.
+
+    Bulk jobs export many contracts into one ZIP archive. They run one at a time and render across a pool of
+    `processes` worker processes, since python-docx is CPU bound.
+    """
+
+    def __init__(self, core, workers=2, processes=None, max_pending=32, keep_finished=3600):
+        self.core = core
+        self.processes = processes or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="docx-export")
+        self._bulk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk-export")
+        self._process_pool = None # started by the first bulk export
+        self._jobs = {} # job_id -> job dict
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._prune_files()
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_finished
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.get("finished_at", time.time()) < cutoff]:
+            job = self._jobs.pop(job_id)
+            if job_id.startswith("bulk-") and "file_path" in job:
+                try:
+                    os.remove(job["file_path"])
+                except FileNotFoundError:
+                    pass
+
+    def _prune_files(self):
+        """Delete bulk archives (and leftovers of interrupted ones) older than keep_finished by mtime, including
+        those whose jobs were lost with a restart or ran in another process."""
+        cutoff = time.time() - self.keep_finished
+        try:
+            entries = list(os.scandir(self.core.contract_export_directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not ((entry.name.startswith("bulk-") and entry.name.endswith(".zip")) or entry.name.endswith(".zip.tmp")):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def submit(self, contract_id):
+        """Queue an export of a contract's current content.
+        Returns (job, message); job is None if the contract doesn't exist or too many exports are pending."""
+        contract = self.core.open_contract(contract_id)
+        if not contract:
+            return None, "Contract not found"
+        job_id = self.core.docx_artifact_id(contract)
+        download_name = f"{self.core.sanitize_filename(contract['metadata']['title']) or 'contract'}.docx"
+
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job and job["status"] in ("queued", "running"):
+                return dict(job), "Export already submitted"
+            if os.path.exists(self.core.docx_path(job_id)):
+                job = {"job_id": job_id, "contract_id": contract_id, "status": "done", "file_path": self.core.docx_path(job_id),
+                       "download_name": download_name, "finished_at": time.time()}
+                self._jobs[job_id] = job
+                return dict(job), "Export is up to date"
+            if self._pending >= self.max_pending:
+                return None, "Too many exports in progress, try again later"
+            job = {"job_id": job_id, "contract_id": contract_id, "status": "queued", "download_name": download_name}
+            self._jobs[job_id] = job
+            self._pending += 1
+            queued = dict(job)
+        self._executor.submit(self._run, job)
+        return queued, "Export queued"
+
+    def _run(self, job):
+        with self._lock:
+            job["status"] = "running"
+        try:
+            # Exports whatever the contract holds now; if it changed since submission, that is the newer content
+            docx_path, message = self.core.convert_to_docx(job["contract_id"])
+        except Exception as e:
+            print(f"Error exporting contract {job['contract_id']}: {e}")
+            docx_path, message = None, "Export failed"
+        with self._lock:
+            self._pending -= 1
+            job["finished_at"] = time.time()
+            if docx_path:
+                job["status"] = "done"
+                job["file_path"] = docx_path
+            else:
+                job["status"] = "failed"
+                job["error"] = message
+
+    def status(self, job_id):
+        """Return a copy of a job, or None if it is unknown. Jobs run by another process are found once their file exists."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return dict(job)
+        if not _ARTIFACT_ID.fullmatch(job_id):
+            return None
+        if job_id.startswith("bulk-"):
+            path, download_name = self._bulk_path(job_id), "contracts.zip"
+        else:
+            path, download_name = self.core.docx_path(job_id), f"{job_id}.docx"
+        if os.path.exists(path):
+            return {"job_id": job_id, "status": "done", "file_path": path, "download_name": download_name}
+        return None
+
+    def _bulk_path(self, job_id):
+        return os.path.join(self.core.contract_export_directory, f"{job_id}.zip")
+
+    def submit_bulk(self, contract_ids):
+        """Queue an export of several contracts into one ZIP archive. Returns (job, message); job is None if too
+        many exports are pending. Contracts that can't be exported are skipped and counted as failed."""
+        job_id = f"bulk-{uuid.uuid4().hex}"
+        with self._lock:
+            self._prune()
+            if self._pending >= self.max_pending:
+                return None, "Too many exports in progress, try again later"
+            job = {"job_id": job_id, "status": "queued", "total": len(contract_ids), "completed": 0, "failed": 0,
+                   "download_name": "contracts.zip"}
+            self._jobs[job_id] = job
+            self._pending += 1
+            queued = dict(job)
+        self._bulk_executor.submit(self._run_bulk, job, list(contract_ids))
+        return queued, "Export queued"
+
+    def _run_bulk(self, job, contract_ids):
+        self._prune_files()
+        with self._lock:
+            job["status"] = "running"
+        zip_path = self._bulk_path(job["job_id"])
+        try:
+            self._write_archive(job, contract_ids, zip_path)
+            failed = False
+        except Exception as e:
+            print(f"Error in bulk export {job['job_id']}: {e}")
+            failed = True
+        with self._lock:
+            self._pending -= 1
+            job["finished_at"] = time.time()
+            if failed:
+                job["status"] = "failed"
+                job["error"] = "Export failed"
+            else:
+                job["status"] = "done"
+                job["file_path"] = zip_path
+
+    def _progress(self, job, failed=False):
+        with self._lock:
+            job["failed" if failed else "completed"] += 1
+
+    def _archive_name(self, contract, names):
+        base = self.core.sanitize_filename(contract["metadata"]["title"]) or "contract"
+        name, number = f"{base}.docx", 1
+        while name in names:
+            number += 1
+            name = f"{base}_{number}.docx"
+        names.add(name)
+        return name
+
+    def _add(self, archive, job, docx_path, name):
+        try:
+            archive.write(docx_path, name)
+        except FileNotFoundError:
+            # Removed since, e.g. superseded by an export of newer content or the contract was deleted
+            self._progress(job, failed=True)
+            return
+        self._progress(job)
+
+    def _write_archive(self, job, contract_ids, zip_path):
+        if self._process_pool is None:
+            # Not fork: a child forked from this multithreaded server could inherit locks held by other threads
+            # (contract locks, connection pools). Workers only get plain contract dicts and a path. They still
+            # import the app's main module, so it must not build Core on import (main.py does so in create_app).
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["core"]) # the renderer, imported once for all workers
+            else:
+                context = multiprocessing.get_context("spawn")
+            self._process_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+        remaining = iter(contract_ids)
+        rendering = {} # future -> (contract_id, docx_path, name in the archive)
+        names = set()
+        tmp_path = zip_path + ".tmp"
+        try:
+            # DOCX files are zip archives already, so they are stored without compressing them again
+            with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as archive:
+                while True:
+                    # Keep two renders per process in flight, so only that many contracts are held in memory at once
+                    while len(rendering) < 2 * self.processes:
+                        contract_id = next(remaining, None)
+                        if contract_id is None:
+                            break
+                        contract = self.core.open_contract(contract_id)
+                        if not contract:
+                            self._progress(job, failed=True)
+                            continue
+                        docx_path = self.core.docx_path(self.core.docx_artifact_id(contract))
+                        name = self._archive_name(contract, names)
+                        if os.path.exists(docx_path):
+                            self._add(archive, job, docx_path, name) # unchanged since its last export
+                        else:
+                            rendering[self._process_pool.submit(render_docx, dict(contract), docx_path)] = (contract_id, docx_path, name)
+                    if not rendering:
+                        break
+
+                    finished, _ = wait(rendering, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        contract_id, docx_path, name = rendering.pop(future)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            print(f"Error exporting contract {contract_id}: {e}")
+                            self._progress(job, failed=True)
+                            continue
+                        self.core.remove_docx(contract_id, keep=docx_path)
+                        self._add(archive, job, docx_path, name)
+            os.replace(tmp_path, zip_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
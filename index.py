@@ -0,0 +1,239 @@
+import base64
+import json
+import re
+from datetime import datetime
+from connections import ConnectionPool
+
+
+class ContractIndex:
+    """SQLite index of contract metadata, so contracts can be listed, filtered and paginated without opening them.
+    It also keeps an FTS5 index of clause titles, latest clause text and comments for search().
+
+    Core keeps it up to date on every save and delete. rebuild() recreates it from the contract store;
+    rebuild_needed is set when the database predates part of the index.
+    """
+
+    SORT_COLUMNS = ("creation_date", "updated_at", "title", "status")
+    SCHEMA_VERSION = 1 # PRAGMA user_version once rebuilt with clause search
+    # Operations that change what a clause's search row holds
+    CLAUSE_OPERATIONS = ("add_clause", "update_clause", "delete_clause", "add_comment", "delete_comment")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.pool = ConnectionPool(self.db_path)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS contract_index
+                                (contract_id TEXT PRIMARY KEY, creator_id TEXT, creator_name TEXT, title TEXT, description TEXT,
+                                 status TEXT, creation_date TEXT, updated_at TEXT, revision INTEGER, collaborators TEXT)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS contract_index_collaborators
+                                (contract_id TEXT, user_id TEXT, role TEXT, PRIMARY KEY (contract_id, user_id))''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_index_creator ON contract_index (creator_id, creation_date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_index_status ON contract_index (status, creation_date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_index_creation_date ON contract_index (creation_date, contract_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_index_updated_at ON contract_index (updated_at, contract_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_index_title ON contract_index (title, contract_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_index_collaborator ON contract_index_collaborators (user_id)')
+            # FTS5 rows are deleted by rowid, which clause_search_rows maps clause ids to
+            cursor.execute('''CREATE TABLE IF NOT EXISTS clause_search_rows
+                                (row_id INTEGER PRIMARY KEY, clause_id TEXT UNIQUE, contract_id TEXT)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clause_search_rows_contract ON clause_search_rows (contract_id)')
+            cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS clause_search
+                              USING fts5(short_title, full_text, comments, tokenize='porter unicode61')''')
+            cursor.execute('PRAGMA user_version')
+            self.rebuild_needed = cursor.fetchone()[0] < self.SCHEMA_VERSION
+            conn.commit()
+
+    def _upsert(self, cursor, metadata, updated_at):
+        contract_id = metadata["contract_id"]
+        cursor.execute('''INSERT OR REPLACE INTO contract_index
+                          (contract_id, creator_id, creator_name, title, description, status, creation_date, updated_at, revision, collaborators)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (contract_id, metadata["creator_id"], metadata["creator_name"], metadata["title"], metadata["description"],
+                        metadata["status"], metadata["creation_date"], updated_at, metadata.get("revision", 0),
+                        json.dumps(metadata["collaborators"])))
+        cursor.execute('DELETE FROM contract_index_collaborators WHERE contract_id = ?', (contract_id,))
+        cursor.executemany('INSERT OR REPLACE INTO contract_index_collaborators (contract_id, user_id, role) VALUES (?, ?, ?)',
+                           [(contract_id, collab["user_id"], collab.get("role")) for collab in metadata["collaborators"]])
+
+    def _remove_clause(self, cursor, clause_id):
+        cursor.execute('SELECT row_id FROM clause_search_rows WHERE clause_id = ?', (clause_id,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('DELETE FROM clause_search WHERE rowid = ?', (row[0],))
+            cursor.execute('DELETE FROM clause_search_rows WHERE row_id = ?', (row[0],))
+
+    def _index_clause(self, cursor, contract_id, clause):
+        self._remove_clause(cursor, clause["clause_id"])
+        cursor.execute('INSERT INTO clause_search_rows (clause_id, contract_id) VALUES (?, ?)', (clause["clause_id"], contract_id))
+        cursor.execute('INSERT INTO clause_search (rowid, short_title, full_text, comments) VALUES (?, ?, ?, ?)',
+                       (cursor.lastrowid, clause["short_title"], clause["versions"][0]["full_text"],
+                        "\n".join(comment["comment"] for comment in clause.get("comments", []))))
+
+    def _remove_clauses(self, cursor, contract_id):
+        cursor.execute('''DELETE FROM clause_search
+                          WHERE rowid IN (SELECT row_id FROM clause_search_rows WHERE contract_id = ?)''', (contract_id,))
+        cursor.execute('DELETE FROM clause_search_rows WHERE contract_id = ?', (contract_id,))
+
+    def _index_clauses(self, cursor, contract, records):
+        contract_id = contract["metadata"]["contract_id"]
+        if records is None:
+            self._remove_clauses(cursor, contract_id)
+            for clause in contract["clauses"]:
+                self._index_clause(cursor, contract_id, clause)
+            return
+        touched = {record["clause"]["clause_id"] if record["op"] == "add_clause" else record["clause_id"]
+                   for record in records if record["op"] in self.CLAUSE_OPERATIONS}
+        clauses = {clause["clause_id"]: clause for clause in contract["clauses"]} if touched else {}
+        for clause_id in touched:
+            if clause_id in clauses:
+                self._index_clause(cursor, contract_id, clauses[clause_id])
+            else:
+                self._remove_clause(cursor, clause_id)
+
+    def update(self, contract, records=None):
+        """Record a contract's current metadata and clause text. Given the operation records just applied to it,
+        only the clauses they touched are reindexed."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            self._upsert(cursor, contract["metadata"], datetime.now().isoformat())
+            self._index_clauses(cursor, contract, records)
+            conn.commit()
+
+    def remove(self, contract_id):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM contract_index WHERE contract_id = ?', (contract_id,))
+            cursor.execute('DELETE FROM contract_index_collaborators WHERE contract_id = ?', (contract_id,))
+            self._remove_clauses(cursor, contract_id)
+            conn.commit()
+
+    def count(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM contract_index')
+            return cursor.fetchone()[0]
+
+    def rebuild(self, store):
+        """Recreate the index from every contract in a store."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM contract_index')
+            cursor.execute('DELETE FROM contract_index_collaborators')
+            cursor.execute('DELETE FROM clause_search')
+            cursor.execute('DELETE FROM clause_search_rows')
+            for contract_id in store.list_ids():
+                try:
+                    contract = store.read(contract_id)
+                except ValueError:
+                    continue # Corrupt, already reported by the store
+                if contract:
+                    # The last edit time isn't stored with the contract, so creation time stands in for it
+                    self._upsert(cursor, contract["metadata"], contract["metadata"]["creation_date"])
+                    self._index_clauses(cursor, contract, None)
+            cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            conn.commit()
+        self.rebuild_needed = False
+
+    def _encode_cursor(self, sort_value, contract_id):
+        return base64.urlsafe_b64encode(json.dumps([sort_value, contract_id]).encode()).decode()
+
+    def _decode_cursor(self, cursor):
+        try:
+            sort_value, contract_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return sort_value, contract_id
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+
+    def query(self, creator_id=None, collaborator_id=None, status=None, title=None, created_after=None, created_before=None,
+              sort="creation_date", descending=True, limit=50, cursor=None):
+        """Return one page of contract metadata matching the filters, and the cursor of the next page (None on the last page).
+        Raises ValueError for an unknown sort column or a malformed cursor."""
+        if sort not in self.SORT_COLUMNS:
+            raise ValueError(f"Invalid sort. Must be one of: {', '.join(self.SORT_COLUMNS)}")
+        column = sort
+
+        conditions, params = [], []
+        if creator_id:
+            conditions.append('creator_id = ?')
+            params.append(creator_id)
+        if collaborator_id:
+            conditions.append('contract_id IN (SELECT contract_id FROM contract_index_collaborators WHERE user_id = ?)')
+            params.append(collaborator_id)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if title:
+            conditions.append("title LIKE ? ESCAPE '\\'")
+            params.append('%' + title.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if created_after:
+            conditions.append('creation_date >= ?')
+            params.append(created_after)
+        if created_before:
+            conditions.append('creation_date < ?')
+            params.append(created_before)
+        # Keyset pagination: continue strictly after the last row of the previous page
+        if cursor:
+            sort_value, last_id = self._decode_cursor(cursor)
+            comparison = '<' if descending else '>'
+            conditions.append(f'({column} {comparison} ? OR ({column} = ? AND contract_id {comparison} ?))')
+            params.extend([sort_value, sort_value, last_id])
+
+        direction = 'DESC' if descending else 'ASC'
+        sql = f'''SELECT contract_id, creator_id, creator_name, title, description, status, creation_date, updated_at, revision, collaborators
+                  FROM contract_index {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                  ORDER BY {column} {direction}, contract_id {direction} LIMIT ?'''
+        params.append(limit + 1) # one extra row tells us whether there is a next page
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        contracts = [{
+            "contract_id": row[0],
+            "creator_id": row[1],
+            "creator_name": row[2],
+            "title": row[3],
+            "description": row[4],
+            "status": row[5],
+            "creation_date": row[6],
+            "updated_at": row[7],
+            "revision": row[8],
+            "collaborators": json.loads(row[9])
+        } for row in rows[:limit]]
+
+        next_cursor = None
+        if len(rows) > limit:
+            last = contracts[-1]
+            next_cursor = self._encode_cursor(last[sort], last["contract_id"])
+        return contracts, next_cursor
+
+    def _match_expression(self, text, include_comments):
+        """FTS5 query for text: every word must appear, as a word or the start of one ("indemnif" finds "indemnification")."""
+        terms = re.findall(r'\w+', text)
+        if not terms:
+            raise ValueError("Search query must contain at least one word")
+        expression = " ".join(f'"{term}"*' for term in terms)
+        return expression if include_comments else f'{{short_title full_text}} : ({expression})'
+
+    def search(self, user_id, text, include_comments=False, limit=20, offset=0):
+        """Return the clauses best matching text, in contracts the user created or collaborates on, with highlighted
+        snippets. Raises ValueError if text has no words to search for."""
+        sql = '''SELECT rows.contract_id, rows.clause_id, contracts.title, clause_search.short_title,
+                        snippet(clause_search, -1, '**', '**', '…', 16), bm25(clause_search, 10.0, 1.0, 0.5) AS score
+                 FROM clause_search
+                 JOIN clause_search_rows AS rows ON rows.row_id = clause_search.rowid
+                 JOIN contract_index AS contracts ON contracts.contract_id = rows.contract_id
+                 WHERE clause_search MATCH ?
+                   AND (contracts.creator_id = ?
+                        OR contracts.contract_id IN (SELECT contract_id FROM contract_index_collaborators WHERE user_id = ?))
+                 ORDER BY score LIMIT ? OFFSET ?'''
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, (self._match_expression(text, include_comments), user_id, user_id, limit, offset)).fetchall()
+        return [{
+            "contract_id": row[0],
+            "clause_id": row[1],
+            "contract_title": row[2],
+            "short_title": row[3],
+            "snippet": row[4],
+            "score": -row[5] # bm25 is lower for better matches
+        } for row in rows]
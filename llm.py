@@ -0,0 +1,232 @@
+'''Gateway between Core and the language model API.
+
+Every call goes through LLMGateway, which bounds how many run at once in this process, gives each a deadline,
+retries transient failures with jittered backoff and stops calling a failing upstream for a while (circuit breaker).
+Backends do the actual calls: OpenAIBackend, or StubBackend for tests and load tests without network.
+'''
+import random
+import threading
+import time
+import httpx
+import openai
+from openai import OpenAI
+
+
+class LLMUnavailable(Exception):
+    """The model can't be reached right now: too busy, timed out, failing, or the circuit breaker is open."""
+
+
+class OpenAIBackend:
+    """Chat completions from the OpenAI API over a shared pool of keep-alive HTTP connections."""
+
+    def __init__(self, api_key=None, max_connections=20):
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60)
+        # Retries are LLMGateway's job, so the client's own are turned off
+        self.client = OpenAI(api_key=api_key, max_retries=0, http_client=httpx.Client(limits=limits))
+
+    def complete(self, model, messages, timeout):
+        response = self.client.chat.completions.create(model=model, messages=messages, timeout=timeout)
+        return response.choices[0].message.content.strip()
+
+    def stream(self, model, messages, timeout):
+        stream = self.client.chat.completions.create(model=model, messages=messages, stream=True, timeout=timeout)
+        with stream: # closing the generator early closes the HTTP response too
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def is_transient(self, error):
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class StubBackend:
+    """Canned answers without network, optionally paced like a real model (delay seconds per word)."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def _words(self, messages):
+        return f"Stub answer about: {messages[-1]['content'][:200]}".split()
+
+    def complete(self, model, messages, timeout):
+        words = self._words(messages)
+        time.sleep(self.delay * len(words))
+        return " ".join(words)
+
+    def stream(self, model, messages, timeout):
+        for word in self._words(messages):
+            time.sleep(self.delay)
+            yield word + " "
+
+    def is_transient(self, error):
+        return False
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds.
+    Then one trial call is let through: success closes the circuit again, failure re-opens it."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True # half-open
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._trial_running else "open"
+
+
+class LLMGateway:
+    """Bounded, deadline-aware access to a backend.
+
+    At most max_concurrency calls run at once; callers wait up to queue_timeout seconds for a slot. Each call,
+    retries included, must finish within timeout seconds. Transient errors are retried up to retries times
+    with full-jitter exponential backoff. LLMUnavailable is raised when a call can't be served.
+    """
+
+    def __init__(self, backend, max_concurrency=8, queue_timeout=10, timeout=60, retries=2, backoff=0.5, breaker=None):
+        self.backend = backend
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._counts = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._count("rejected")
+            raise LLMUnavailable("Too many AI requests in progress, try again later")
+        if not self.breaker.allow():
+            self._slots.release()
+            self._count("rejected")
+            raise LLMUnavailable("The AI service is unavailable, try again later")
+        self._count("calls")
+
+    def _record_error(self, error):
+        """Tell the circuit breaker about a failed attempt. Returns whether the error is transient."""
+        if self.backend.is_transient(error):
+            self.breaker.record_failure()
+            return True
+        self.breaker.record_success() # e.g. a rejected request: upstream itself is answering
+        return False
+
+    def _retry_delay(self, attempt, deadline, error):
+        """Seconds to wait before retrying after a failed attempt, or None if the error is final."""
+        if not self._record_error(error) or attempt >= self.retries:
+            return None
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def complete(self, model, messages):
+        """Return the model's answer to messages."""
+        self._acquire()
+        try:
+            deadline = time.monotonic() + self.timeout
+            attempt = 0
+            while True:
+                try:
+                    answer = self.backend.complete(model, messages, timeout=max(deadline - time.monotonic(), 0.1))
+                    self.breaker.record_success()
+                    return answer
+                except Exception as e:
+                    delay = self._retry_delay(attempt, deadline, e)
+                    if delay is None:
+                        self._count("failures")
+                        if self.backend.is_transient(e):
+                            raise LLMUnavailable("The AI service did not respond, try again later") from e
+                        raise
+                    self._count("retries")
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            self._slots.release()
+
+    def stream(self, model, messages):
+        """Yield the model's answer in pieces as they arrive. Failures are only retried before the first piece.
+        The deadline covers the whole stream, including time spent waiting for the caller to take each piece."""
+        self._acquire()
+        try:
+            deadline = time.monotonic() + self.timeout
+            attempt = 0
+            while True:
+                started = False
+                parts = self.backend.stream(model, messages, timeout=max(deadline - time.monotonic(), 0.1))
+                try:
+                    for part in parts:
+                        if time.monotonic() > deadline:
+                            # A slow trickle of pieces, or a slow reader, mustn't hold the slot indefinitely
+                            raise LLMUnavailable("The AI service took too long to answer, try again later")
+                        started = True
+                        yield part
+                    self.breaker.record_success()
+                    return
+                except GeneratorExit:
+                    self.breaker.record_success() # the caller stopped reading, e.g. the client disconnected
+                    raise
+                except LLMUnavailable:
+                    self.breaker.record_failure() # a timeout, like a transient error; also ends a half-open trial
+                    self._count("failures")
+                    raise
+                except Exception as e:
+                    if started:
+                        self._record_error(e)
+                        delay = None
+                    else:
+                        delay = self._retry_delay(attempt, deadline, e)
+                    if delay is None:
+                        self._count("failures")
+                        if self.backend.is_transient(e):
+                            raise LLMUnavailable("The AI service did not respond, try again later") from e
+                        raise
+                    self._count("retries")
+                    time.sleep(delay)
+                    attempt += 1
+                finally:
+                    parts.close()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats["circuit"] = self.breaker.state
+        return stats
@@ -0,0 +1,132 @@
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows: cross-process locking is not available
+    fcntl = None
+
+
+class ReadWriteLock:
+    """Many concurrent readers or a single writer. Waiting writers block new readers so saves are not starved."""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class ContractLocks:
+    """Per-contract read/write locks, created on demand and dropped once no thread is using them.
+
+    With a lock_directory, each lock is also backed by an advisory fcntl lock, so several worker processes sharing
+    one contract directory exclude each other too. Contract ids are hashed onto a fixed set of file_stripes lock
+    files, so the number of files stays bounded however many ids are requested; contracts sharing a file only
+    contend across processes, never deadlock, since nothing holds two contracts' locks at once.
+    """
+
+    def __init__(self, lock_directory=None, file_stripes=256):
+        self._guard = threading.Lock()
+        self._locks = {} # contract_id -> [ReadWriteLock, number of threads holding or waiting]
+        self.lock_directory = lock_directory
+        self.file_stripes = file_stripes
+        if lock_directory:
+            if fcntl is None:
+                raise RuntimeError("Multi-process mode needs fcntl, which is not available on this platform")
+            os.makedirs(lock_directory, exist_ok=True)
+            # Per-contract lock files left by older versions
+            for entry in os.scandir(lock_directory):
+                if entry.name.endswith(".lock") and not entry.name.startswith("stripe-"):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def _checkout(self, contract_id):
+        with self._guard:
+            entry = self._locks.get(contract_id)
+            if entry is None:
+                entry = self._locks[contract_id] = [ReadWriteLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, contract_id):
+        with self._guard:
+            entry = self._locks[contract_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[contract_id]
+
+    def _lock_path(self, contract_id):
+        # crc32 rather than hash(), which differs between processes
+        stripe = zlib.crc32(contract_id.encode()) % self.file_stripes
+        return os.path.join(self.lock_directory, f"stripe-{stripe}.lock")
+
+    @contextmanager
+    def _file_lock(self, contract_id, exclusive):
+        if not self.lock_directory:
+            yield
+            return
+        # Lock a sidecar file rather than the contract itself: saves rename a new file over the contract,
+        # which would leave other processes holding a lock on the old one.
+        # Opened per acquisition: flock locks belong to an open file, so threads sharing one would share the lock.
+        with open(self._lock_path(contract_id), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def read(self, contract_id):
+        lock = self._checkout(contract_id)
+        try:
+            lock.acquire_read()
+            try:
+                with self._file_lock(contract_id, exclusive=False):
+                    yield
+            finally:
+                lock.release_read()
+        finally:
+            self._checkin(contract_id)
+
+    @contextmanager
+    def write(self, contract_id):
+        lock = self._checkout(contract_id)
+        try:
+            lock.acquire_write()
+            try:
+                with self._file_lock(contract_id, exclusive=True):
+                    yield
+            finally:
+                lock.release_write()
+        finally:
+            self._checkin(contract_id)
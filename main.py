@@ -1,9 +1,14 @@
-from flask import Flask, request, jsonify, send_file, session
+from flask import Flask, request, jsonify, send_file, session, Response, stream_with_context
 from flask_cors import CORS
 from core import Core
+from codec import InvalidContract
+from exports import ExportJobs
+from llm import LLMUnavailable
+from model import find_clause
 from database import Database
 import os
 import json
+import secrets
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,16 +17,66 @@ app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
 CORS(app)
 
-contract_manager = Core()
-database=Database()
+# Built by create_app(). Importing this module alone must stay cheap: bulk export worker processes
+# re-import the main module, and they shouldn't open the stores or start threads of their own
+contract_manager = None
+export_jobs = None
+database = None
 
-TEMPLATE_DIR = "../store/templates"
+def create_app():
+    '''Set up the contract store, export jobs and database, and return the app. Called once per process.'''
+    global contract_manager, export_jobs, database
+    if contract_manager is not None:
+        return app
+    # Set CONTRACTS_MULTIPROCESS=1 when several worker processes share the store (see wsgi.py)
+    # Set CONTRACTS_OPERATION_LOG=1 to append edits to a per-contract log instead of rewriting the whole contract
+    # Set CONTRACTS_STORAGE=sqlite to keep contracts in ../store/contracts.db instead of JSON files (see migrate_store.py)
+    # CONTRACTS_SNAPSHOT_FORMAT picks how those files are written: json (compact, default), pretty or msgpack
+    # Set CONTRACTS_LLM_BACKEND=stub to answer AI requests locally (no network), e.g. for load tests.
+    # CONTRACTS_LLM_CONCURRENCY (default 8) bounds model calls per process, CONTRACTS_LLM_TIMEOUT (default 60) is their deadline in seconds
+    contract_manager = Core(
+        multiprocess=os.getenv("CONTRACTS_MULTIPROCESS") == "1",
+        operation_log=os.getenv("CONTRACTS_OPERATION_LOG") == "1",
+        storage=os.getenv("CONTRACTS_STORAGE", "json"),
+        snapshot_format=os.getenv("CONTRACTS_SNAPSHOT_FORMAT", "json"),
+        llm_backend=os.getenv("CONTRACTS_LLM_BACKEND", "openai"),
+        llm_concurrency=int(os.getenv("CONTRACTS_LLM_CONCURRENCY", "8")),
+        llm_timeout=float(os.getenv("CONTRACTS_LLM_TIMEOUT", "60"))
+    )
+    # DOCX exports run on CONTRACTS_EXPORT_WORKERS background threads (default 2); bulk exports render on
+    # CONTRACTS_EXPORT_PROCESSES worker processes (default: one per CPU)
+    export_jobs = ExportJobs(
+        contract_manager,
+        workers=int(os.getenv("CONTRACTS_EXPORT_WORKERS", "2")),
+        processes=int(os.getenv("CONTRACTS_EXPORT_PROCESSES", "0")) or None
+    )
+    database = Database()
+    return app
+
+MAX_BATCH_OPERATIONS = 500
+MAX_BULK_EXPORT = 1000
+MAX_EXPLAIN_PARALLELISM = 8
+
+# Changes the contract schema can't store, e.g. a user_id that isn't a string (see codec.py)
+@app.errorhandler(InvalidContract)
+def invalid_contract(e):
+    return jsonify({'error': str(e)}), 400
 
 # Pinging the system
 @app.route('/ping', methods=['GET'])
 def ping():
     return {'status': 'running'}
 
+# Cache hit/miss counters for monitoring
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'contract_cache': contract_manager.cache.stats(),
+        'profile_cache': database.profile_cache.stats(),
+        'explanation_cache': contract_manager.explanations.stats(),
+        'llm': contract_manager.llm.stats()
+    }), 200
+
 @app.route('/create_contract', methods=['POST'])
 def create_contract():
     data = request.get_json()
@@ -55,9 +110,20 @@ def create_contract():
 
 @app.route('/templates', methods=['GET'])
 def get_templates():
-    '''Retrieve a list of available contract templates.'''
-    templates = [f.replace(".json", "") for f in os.listdir(TEMPLATE_DIR) if f.endswith(".json")]
-    return jsonify({"templates": templates}), 200
+    '''Retrieve a list of available contract templates, with their descriptions and clause counts.'''
+    details = contract_manager.templates.list()
+    return jsonify({"templates": [template["name"] for template in details], "details": details}), 200
+
+@app.route('/templates/<template_name>', methods=['GET'])
+def get_template(template_name):
+    '''Retrieve a template's metadata and clauses.'''
+    try:
+        template = contract_manager.templates.get(template_name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not template:
+        return jsonify({'error': 'Template not found'}), 404
+    return jsonify(template), 200
 
 @app.route('/create_contract_from_template', methods=['POST'])
 def create_contract_from_template():
@@ -80,14 +146,14 @@ def create_contract_from_template():
     if 'name' not in profile:
         return jsonify({'error': 'Account does not exist'}), 401
     
-    # Load the template
-    template_path = os.path.join('../store/templates', f"{data['template_name']}.json")
-    if not os.path.exists(template_path):
+    # Templates are served from memory
+    try:
+        template_data = contract_manager.templates.get(data['template_name'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not template_data:
         return jsonify({'error': 'Template not found'}), 404
     
-    with open(template_path, "r") as f:
-        template_data = json.load(f)
-    
     contract_id = contract_manager.create_contract(
         creator_id = data['user_id'],
         creator_name = profile['name'],
@@ -102,12 +168,18 @@ def create_contract_from_template():
     
     return jsonify({'contract_id': contract_id}), 201
 
+# view=full|latest|compact|metadata or fields=metadata,clauses,history,comments limit what is returned
 @app.route('/contracts/<contract_id>', methods=['GET'])
 def get_contract(contract_id):
+    try:
+        fields = contract_manager.resolve_fields(request.args.get('view'), request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     contract = contract_manager.open_contract(contract_id)
     if not contract:
         return jsonify({'error': 'Contract not found'}), 404
-    return jsonify(contract)
+    return jsonify(contract_manager.project_contract(contract, fields))
 
 @app.route('/contracts/<contract_id>/clauses', methods=['POST'])
 def add_clause(contract_id):
@@ -115,27 +187,20 @@ def add_clause(contract_id):
     if not data or 'short_title' not in data or 'full_text' not in data or 'user_id' not in data:
         return jsonify({'error': 'Missing required fields'}), 400
 
-    # Check if user has permission to add clauses (creator or editor)
-    contract = contract_manager.open_contract(contract_id)
-    if not contract:
-        return jsonify({'error': 'Contract not found'}), 404
-    
-    user_id = data['user_id']
-    if contract['metadata']['creator_id'] != user_id:
-        has_permission = False
-        for collab in contract['metadata']['collaborators']:
-            if collab["user_id"] == user_id and collab['role'] == 'Editor':
-                has_permission = True
-                break
-        if not has_permission:
+    # One load and one save; the permission check and the change happen under the same lock
+    with contract_manager.edit(contract_id, data['user_id']) as edit:
+        if not edit.contract:
+            return jsonify({'error': 'Contract not found'}), 404
+        
+        # Check if user has permission to add clauses (creator or editor)
+        if not edit.can_edit:
             return jsonify({'error': 'Permission denied. Only creator or editors can add clauses'}), 403
-    
-    clause = contract_manager.add_clause(
-        contract_id=contract_id,
-        short_title=data['short_title'],
-        full_text=data['full_text'],
-        publisher=data['user_id']
-    )
+        
+        clause = edit.add_clause(
+            short_title=data['short_title'],
+            full_text=data['full_text'],
+            publisher=data['user_id']
+        )
     
     if clause:
         return jsonify({
@@ -152,56 +217,76 @@ def update_clause(contract_id, clause_id):
     if not data or 'full_text' not in data or 'user_id' not in data:
         return jsonify({'error': 'Missing required fields'}), 400
 
-    # Open contract
-    contract = contract_manager.open_contract(contract_id)
-    if not contract: 
-        return jsonify ({'error': "Contract not found"}), 404
-            
-    user_id = data['user_id']
-    
-    # Check if user has permission to update clauses (creator or editor)
-    if contract['metadata']['creator_id'] != user_id:
-        has_permission = False
-        for collab in contract['metadata']['collaborators']:
-            if collab["user_id"] == user_id and collab['role'] == 'Editor':
-                has_permission = True
-                break
-        if not has_permission:
+    with contract_manager.edit(contract_id, data['user_id']) as edit:
+        if not edit.contract: 
+            return jsonify ({'error': "Contract not found"}), 404
+        
+        # Check if user has permission to update clauses (creator or editor)
+        if not edit.can_edit:
             return jsonify({'error': 'Permission denied. Only creator or editors can update clauses'}), 403
+        
+        # Publisher name from contract metadata
+        publisher_name = edit.user_name or "Unknown"
+        
+        # Update Clause
+        updated = edit.update_clause(
+            clause_id=clause_id,
+            full_text=data['full_text'],
+            publisher_id=data['user_id'],
+            publisher_name= publisher_name,
+            short_title=data.get('short_title') # For optional renaming
+        )
     
-    # Find publisher name from contract metadata
-    publisher_name = "Unknown"
-    if contract['metadata']['creator_id'] == user_id:
-        publisher_name = contract['metadata']['creator_name']
-    else:
-        for collab in contract['metadata']['collaborators']:
-            if collab["user_id"] == user_id:
-                publisher_name = collab['name']
-                break
-    
-    # Update Clause
-    if contract_manager.update_clause(
-        contract_id=contract_id,
-        clause_id=clause_id,
-        full_text=data['full_text'],
-        publisher_id=data['user_id'],
-        publisher_name= publisher_name,
-        short_title=data.get('short_title') # For optional renaming
-    ):
+    if updated:
         return jsonify({
             'message': 'Clause updated successfully',
             'publisher_name': publisher_name}), 200
     else:
         return jsonify({'error': 'Contract or clause not found'}), 404
     
+# Apply many clause changes at once (e.g. importing a pasted agreement)
+@app.route('/contracts/<contract_id>/clauses/batch', methods=['POST'])
+def batch_clauses(contract_id):
+    '''Apply a list of add/update/delete/move clause operations atomically, with one load and one save'''
+    data = request.get_json()
+    if not data or 'user_id' not in data or 'operations' not in data:
+        return jsonify({'error': 'Missing required fields'}), 400
+    if not isinstance(data['operations'], list) or not all(isinstance(op, dict) for op in data['operations']):
+        return jsonify({'error': 'operations must be a list of objects'}), 400
+    if len(data['operations']) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per batch'}), 400
+    
+    success, message, results = contract_manager.apply_clause_operations(contract_id, data['user_id'], data['operations'])
+    if results is None:
+        if message == 'Contract not found':
+            return jsonify({'error': message}), 404
+        return jsonify({'error': message}), 403
+    if not success:
+        return jsonify({'error': message, 'results': results}), 400
+    
+    return jsonify({'message': message, 'results': results}), 200
+
 # Get all the clauses for a contract
 @app.route('/contracts/<contract_id>/clauses', methods=['GET'])
 def get_clauses(contract_id):
-    clauses = contract_manager.get_clauses(contract_id)
+    try:
+        fields = contract_manager.resolve_fields(request.args.get('view'), request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    clauses = contract_manager.get_clauses(contract_id, fields)
     if not clauses:
         return jsonify({'error': 'Contract not found'}), 404
     return jsonify(clauses), 200
 
+# Get one version of a clause (0 is the latest), rebuilt from the stored history
+@app.route('/contracts/<contract_id>/clauses/<clause_id>/versions/<int:number>', methods=['GET'])
+def get_clause_version(contract_id, clause_id, number):
+    version = contract_manager.get_clause_version(contract_id, clause_id, number)
+    if not version:
+        return jsonify({'error': 'Contract, clause or version not found'}), 404
+    return jsonify(version), 200
+
 # Add collaborator using email
 @app.route('/contracts/<contract_id>/collaborators', methods=['POST'])
 def add_collaborator(contract_id):
@@ -214,15 +299,11 @@ def add_collaborator(contract_id):
     if data['role'] not in valid_roles:
         return jsonify({'error': 'Invalid role. Must be one of: ' + ', '.join(valid_roles)}), 400
     
-    # Check if the email exists in the database
-    if not database.email_exists(data['email']):
+    # Get user profile by email, if the email exists
+    collab_profile = database.find_user_by_email(data['email'])
+    if not collab_profile:
         return jsonify({'error': 'Email does not exist'}), 404
     
-    # Get user profile by email
-    collab_profile = database.get_user_by_email(data['email'])
-    if 'user_id' not in collab_profile:
-        return jsonify({'error': 'User not found'}), 500
-    
     # Prepare collaborator data
     collaborator_data = {
         'user_id': collab_profile['user_id'],
@@ -280,13 +361,11 @@ def update_role(contract_id, collaborator_id):
     if data['new_role'] not in valid_roles:
         return jsonify({'error': 'Invalid role. Must be one of: ' + ', '.join(valid_roles)}), 400
     
-    # Open the contract
-    contract = contract_manager.open_contract(contract_id)
-    if not contract:
-        return jsonify({'error': 'Contract not found'}), 404
-    
     # Update role
-    success, message = contract_manager.update_role(contract_id, collaborator_id, data['new_role'], data['user_id'] )
+    with contract_manager.edit(contract_id) as edit:
+        if not edit.contract:
+            return jsonify({'error': 'Contract not found'}), 404
+        success, message = edit.update_role(collaborator_id, data['new_role'], data['user_id'])
     if not success:
         return jsonify({'error': message}), 400
     
@@ -362,16 +441,15 @@ def delete_contract(contract_id):
     if not data or 'user_id' not in data:
         return jsonify({'error': 'Missing user_id field'}), 400
     
-    # Open contract to get creator_id
-    contract = contract_manager.open_contract(contract_id)
-    if not contract:
-        return jsonify({'error': 'Contract not found'}), 404
-    
-    creator_id = contract['metadata']['creator_id']
-    if creator_id != data["user_id"]:
-        return jsonify({'error': 'You are not authorized to delete this contract'}), 403
-    
-    success = contract_manager.delete_contract(contract_id)
+    with contract_manager.edit(contract_id, data['user_id']) as edit:
+        if not edit.contract:
+            return jsonify({'error': 'Contract not found'}), 404
+        
+        # Only the creator can delete a contract
+        if edit.role != 'Creator':
+            return jsonify({'error': 'You are not authorized to delete this contract'}), 403
+        
+        success = edit.delete_contract()
     if success:
         # Remove from database
         db_success = database.delete_contract(contract_id)
@@ -384,10 +462,59 @@ def delete_contract(contract_id):
 
 @app.route('/contracts', methods=['GET'])
 def list_contracts():
+    '''List contract metadata, filtered and sorted, one page at a time (pass next_cursor back as cursor)'''
+    order = request.args.get('order', 'desc')
+    if order not in ['asc', 'desc']:
+        return jsonify({'error': 'Invalid order. Must be one of: asc, desc'}), 400
+    
+    try:
+        limit = min(int(request.args.get('limit', 50)), 200)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    
+    try:
+        contracts, next_cursor = contract_manager.list_contracts(
+            creator_id=request.args.get('user_id'),
+            collaborator_id=request.args.get('collaborator_id'),
+            status=request.args.get('status'),
+            title=request.args.get('title'),
+            created_after=request.args.get('created_after'),
+            created_before=request.args.get('created_before'),
+            sort=request.args.get('sort', 'creation_date'),
+            descending=order == 'desc',
+            limit=limit,
+            cursor=request.args.get('cursor')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'contracts': contracts, 'next_cursor': next_cursor}), 200
+
+@app.route('/search', methods=['GET'])
+def search_clauses():
+    '''Full-text search over clauses the user can access; comments=1 also searches clause comments'''
     user_id = request.args.get('user_id')
-    collaborator_id = request.args.get('collaborator_id')
-    contracts = contract_manager.list_contracts(user_id, collaborator_id)
-    return jsonify(contracts)
+    query = request.args.get('q')
+    if not all([user_id, query]):
+        return jsonify({'error': 'user_id and q are required'}), 400
+    
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be numbers'}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({'error': 'limit must be at least 1 and offset not negative'}), 400
+    
+    try:
+        results = contract_manager.search_clauses(user_id, query, include_comments=request.args.get('comments') == '1',
+                                                  limit=limit, offset=offset)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'results': results}), 200
 
 @app.route('/users/<user_id>/contracts', methods=['GET'])
 def get_user_contracts(user_id):
@@ -414,23 +541,16 @@ def reorder_clauses(contract_id, clause_id):
     if not data or 'new_index' not in data or 'user_id' not in data:
         return jsonify({'error': 'Missing required fields'}), 400
     
-    # Open contract
-    contract = contract_manager.open_contract(contract_id)
-    if not contract:
-        return jsonify({'error': 'Contract not found'}), 404
-    
-    # Check if user has permission to reorder clauses (creator or editor)
-    user_id = data['user_id']
-    if contract ['metadata']['creator_id'] != user_id:
-        has_permission = any(
-            collab['user_id'] == user_id and collab['role'] == 'Editor'
-            for collab in contract['metadata']['collaborators']
-        )
-        if not has_permission:
+    with contract_manager.edit(contract_id, data['user_id']) as edit:
+        if not edit.contract:
+            return jsonify({'error': 'Contract not found'}), 404
+        
+        # Check if user has permission to reorder clauses (creator or editor)
+        if not edit.can_edit:
             return jsonify({'error': 'Permission denied. Only creator or editors can reorder clauses'}), 403
         
-    # Update clause position
-    success, message = contract_manager.move_clause(contract_id, clause_id, data['new_index'])
+        # Update clause position
+        success, message = edit.move_clause(clause_id, data['new_index'])
     if not success:
         return jsonify({'error': message}), 400
         
@@ -462,6 +582,69 @@ def export_contract(contract_id):
         return jsonify({'error': message}), 404
     
     return jsonify({'message': 'DOCX file generated successfully', 'file_path': docx_path}), 200
+
+def _export_job_response(job, message=None):
+    response = {key: job[key] for key in ("job_id", "contract_id", "status", "total", "completed", "failed", "error") if key in job}
+    if message:
+        response['message'] = message
+    if job['status'] == 'done':
+        response['download_url'] = f"/exports/{job['job_id']}/download"
+    return response
+
+# Queue a DOCX export; poll GET /exports/<job_id> until it is done, then download it
+@app.route('/contracts/<contract_id>/export', methods=['POST'])
+def submit_export(contract_id):
+    job, message = export_jobs.submit(contract_id)
+    if not job:
+        return jsonify({'error': message}), 404 if message == 'Contract not found' else 503
+    return jsonify(_export_job_response(job, message)), 200 if job['status'] == 'done' else 202
+
+# Export many contracts into one ZIP: either {"contract_ids": [...]} or the filters of GET /contracts
+@app.route('/exports/bulk', methods=['POST'])
+def submit_bulk_export():
+    data = request.get_json(silent=True) or {}
+    if 'contract_ids' in data:
+        contract_ids = data['contract_ids']
+        if not isinstance(contract_ids, list) or not all(isinstance(contract_id, str) for contract_id in contract_ids):
+            return jsonify({'error': 'contract_ids must be a list of contract ids'}), 400
+        contract_ids = list(dict.fromkeys(contract_ids))
+    else:
+        contract_ids = contract_manager.matching_contract_ids(
+            MAX_BULK_EXPORT + 1,
+            creator_id=data.get('user_id'),
+            collaborator_id=data.get('collaborator_id'),
+            status=data.get('status'),
+            title=data.get('title'),
+            created_after=data.get('created_after'),
+            created_before=data.get('created_before')
+        )
+    if not contract_ids:
+        return jsonify({'error': 'No contracts to export'}), 400
+    if len(contract_ids) > MAX_BULK_EXPORT:
+        return jsonify({'error': f'At most {MAX_BULK_EXPORT} contracts can be exported at once'}), 400
+    
+    job, message = export_jobs.submit_bulk(contract_ids)
+    if not job:
+        return jsonify({'error': message}), 503
+    return jsonify(_export_job_response(job, message)), 202
+
+@app.route('/exports/<job_id>', methods=['GET'])
+def export_status(job_id):
+    job = export_jobs.status(job_id)
+    if not job:
+        return jsonify({'error': 'Export job not found'}), 404
+    return jsonify(_export_job_response(job)), 200
+
+@app.route('/exports/<job_id>/download', methods=['GET'])
+def download_export(job_id):
+    job = export_jobs.status(job_id)
+    if not job or job['status'] != 'done':
+        return jsonify({'error': 'Export job not found or not finished'}), 404
+    try:
+        return send_file(job['file_path'], as_attachment=True, download_name=job['download_name'])
+    except FileNotFoundError:
+        # Superseded by an export of newer content
+        return jsonify({'error': 'Export has expired, submit it again'}), 410
     
 @app.route('/contracts/<contract_id>/clauses/<clause_id>/explain', methods=['GET'])
 def explain_clause(contract_id, clause_id):
@@ -471,13 +654,16 @@ def explain_clause(contract_id, clause_id):
         return jsonify({'error': 'Contract not found'}), 404
     
     # Find the clause
-    clause = next((c for c in contract["clauses"] if c["clause_id"] == clause_id), None)
+    clause = find_clause(contract, clause_id)
     if not clause:
         return jsonify({'error': 'Clause not found'}), 404
     
     # Get latest version of the clause
     latest_version = clause["versions"][0]
-    explanation = contract_manager.explain_clause(latest_version["full_text"])
+    try:
+        explanation = contract_manager.explain_clause(latest_version["full_text"])
+    except LLMUnavailable as e:
+        return jsonify({'error': str(e)}), 503
     
     return jsonify({'explanation': explanation}), 200
                       
@@ -493,32 +679,132 @@ def ask_clause_question(contract_id, clause_id):
         return jsonify({'error': 'Contract not found'}), 404
     
     # Find the clause
-    clause = next((c for c in contract["clauses"] if c["clause_id"] == clause_id), None)
+    clause = find_clause(contract, clause_id)
     if not clause:
         return jsonify({'error': 'Clause not found'}), 404
     
     latest_version = clause["versions"] [0] ["full_text"]
     
-    # Create a unique session key for this conversation
-    session_key = f"{contract_id}_{clause_id}_chat"
-    if session_key not in session:
-        session[session_key] = [] # Initialize conversation history
-        
-    conversation_history = session[session_key]
+    # The conversation is kept on the server; the model sees a summary of older turns and the recent ones
+    owner = _conversation_owner()
+    user_question = data["question"]
+    #Get answer
+    try:
+        answer = contract_manager.ask_clause_question(owner, contract_id, clause_id, latest_version, user_question)
+    except LLMUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    
+    summary, conversation = contract_manager.clause_conversation(owner, contract_id, clause_id)
+    return jsonify({'answer': answer, 'summary': summary, 'conversation': conversation}), 200
+
+def _conversation_owner():
+    """Whose conversation this is: a random chat id kept in the signed session cookie. Not the request's user_id,
+    which anyone can send, since the response carries the conversation's history"""
+    if "chat_id" not in session:
+        session["chat_id"] = secrets.token_hex(16)
+    return session["chat_id"]
+
+def _latest_clause_text(contract_id, clause_id):
+    """Return (latest clause text, None), or (None, error response) if the contract or clause doesn't exist"""
+    contract = contract_manager.open_contract(contract_id)
+    if not contract:
+        return None, (jsonify({'error': 'Contract not found'}), 404)
+    clause = find_clause(contract, clause_id)
+    if not clause:
+        return None, (jsonify({'error': 'Clause not found'}), 404)
+    return clause["versions"][0]["full_text"], None
+
+def _sse(data, event=None):
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+def _event_stream(events):
+    # Proxies must pass events through as they come instead of buffering the response
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Streaming variants of /explain and /ask: server-sent events with {"token": ...} pieces of the answer as the
+# model produces them, then a "done" event with the whole answer (or an "error" event)
+@app.route('/contracts/<contract_id>/clauses/<clause_id>/explain/stream', methods=['GET'])
+def stream_clause_explanation(contract_id, clause_id):
+    clause_text, error = _latest_clause_text(contract_id, clause_id)
+    if error:
+        return error
+    
+    def events():
+        parts = []
+        try:
+            for part in contract_manager.stream_clause_explanation(clause_text):
+                parts.append(part)
+                yield _sse({'token': part})
+        except LLMUnavailable as e:
+            yield _sse({'error': str(e)}, event='error')
+            return
+        except Exception as e:
+            print(f"Error streaming explanation: {e}")
+            yield _sse({'error': 'Explanation failed'}, event='error')
+            return
+        yield _sse({'explanation': "".join(parts).strip()}, event='done')
+    
+    return _event_stream(events())
+
+@app.route('/contracts/<contract_id>/clauses/<clause_id>/ask/stream', methods=['POST'])
+def stream_clause_question(contract_id, clause_id):
+    data = request.get_json()
+    if not data or "question" not in data:
+        return jsonify({'error': 'Missing question parameter'}), 400
     
-    # Store the user's question in the session
+    clause_text, error = _latest_clause_text(contract_id, clause_id)
+    if error:
+        return error
+    
+    # Resolved before the response starts: the session cookie goes out with the headers
+    owner = _conversation_owner()
     user_question = data["question"]
     
-    if not conversation_history or conversation_history[-1]["content"] != data["question"]:
-        conversation_history.append({"role": "user", "content": data["question"]})
-    #Get answer
-    answer = contract_manager.ask_clause_question(latest_version, conversation_history, user_question)
-    # Then append AI response to conversation history
-    conversation_history.append({"role": "assistant", "content": answer})
-    session[session_key] = conversation_history # Update session history
+    def events():
+        parts = []
+        try:
+            for part in contract_manager.stream_clause_question(owner, contract_id, clause_id, clause_text, user_question):
+                parts.append(part)
+                yield _sse({'token': part})
+        except LLMUnavailable as e:
+            yield _sse({'error': str(e)}, event='error')
+            return
+        except Exception as e:
+            print(f"Error streaming answer: {e}")
+            yield _sse({'error': 'Answering the question failed'}, event='error')
+            return
+        summary, conversation = contract_manager.clause_conversation(owner, contract_id, clause_id)
+        yield _sse({'answer': "".join(parts).strip(), 'summary': summary, 'conversation': conversation}, event='done')
+    
+    return _event_stream(events())
+
+# Explain every clause of a contract: a "clause" event per clause as it completes, then a "done" event with a
+# summary of the whole contract. parallelism (default 4) bounds how many clauses are explained at once
+@app.route('/contracts/<contract_id>/explain', methods=['GET'])
+def explain_contract(contract_id):
+    try:
+        parallelism = min(int(request.args.get('parallelism', 4)), MAX_EXPLAIN_PARALLELISM)
+    except ValueError:
+        return jsonify({'error': 'parallelism must be a number'}), 400
+    if parallelism < 1:
+        return jsonify({'error': 'parallelism must be at least 1'}), 400
+    
+    contract = contract_manager.open_contract(contract_id)
+    if not contract:
+        return jsonify({'error': 'Contract not found'}), 404
+    
+    def events():
+        try:
+            for kind, result in contract_manager.explain_contract(contract, parallelism):
+                yield _sse(result, event='clause' if kind == 'clause' else 'done')
+        except Exception as e:
+            # Always end with an event, so the client doesn't wait for one that never comes
+            print(f"Error explaining contract: {e}")
+            yield _sse({'error': 'Explanation failed'}, event='error')
     
-    return jsonify({'answer': answer, 'conversation': conversation_history}), 200
+    return _event_stream(events())
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0',port='8081')
\ No newline at end of file
+    create_app().run(host='0.0.0.0',port='8081')
\ No newline at end of file
@@ -0,0 +1,45 @@
+'''Copy every contract from the JSON file store into the SQLite store (or back, with --reverse).
+
+    python migrate_store.py [--json-dir ../store/json] [--db ../store/contracts.db] [--reverse] [--compress-history]
+                            [--format json|pretty|msgpack]
+
+Stop the app first, then start it with CONTRACTS_STORAGE=sqlite once the copy is done.
+
+--compress-history stores older clause versions as deltas while copying. To compress the histories of an existing
+store without moving it, use --in-place json (or sqlite) --compress-history.
+
+--format sets how JSON store snapshots are written (see codec.py). Existing snapshot files are converted in bulk with
+--in-place json --format msgpack (or json, or pretty).
+'''
+import argparse
+from cache import ContractCache
+from codec import SNAPSHOT_FORMATS
+from locks import ContractLocks
+from storage import JsonFileStore, SQLiteStore, migrate_contracts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate contracts between the JSON file store and the SQLite store")
+    parser.add_argument("--json-dir", default="../store/json")
+    parser.add_argument("--db", default="../store/contracts.db")
+    parser.add_argument("--reverse", action="store_true", help="copy from SQLite back into JSON files")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--compress-history", action="store_true", help="store older clause versions as deltas")
+    parser.add_argument("--in-place", choices=("json", "sqlite"), help="rewrite this store onto itself instead of copying")
+    parser.add_argument("--format", choices=SNAPSHOT_FORMATS, default="json", help="file format of JSON store snapshots written")
+    args = parser.parse_args()
+
+    cache = ContractCache(0) # nothing worth caching during a one-off copy
+    json_store = JsonFileStore(args.json_dir, ContractLocks(), cache, snapshot_format=args.format)
+    sqlite_store = SQLiteStore(args.db, cache)
+    if args.in_place:
+        source = target = json_store if args.in_place == "json" else sqlite_store
+    else:
+        source, target = (sqlite_store, json_store) if args.reverse else (json_store, sqlite_store)
+
+    count = migrate_contracts(source, target, batch_size=args.batch_size, compress_history=args.compress_history)
+    print(f"Migrated {count} contracts")
+
+
+if __name__ == "__main__":
+    main()
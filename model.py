@@ -0,0 +1,73 @@
+'''In-memory contract documents with constant-time clause and collaborator lookups.
+
+A Contract is the same nested dict that is stored and returned by the API, so it serializes, caches and projects
+like any other contract. It also keeps clause_id -> clause and user_id -> collaborator indexes, built on first
+use and kept up to date by apply_operation (see operations.py), so finding a clause or checking a role doesn't
+scan the contract. The stores return Contract objects; find_clause and find_collaborator also accept plain dicts.
+'''
+
+
+class Contract(dict):
+    """A contract document with clause and collaborator indexes. Code that changes the clause or collaborator
+    lists other than through apply_operation must call reindex()."""
+
+    __slots__ = ("_clauses", "_collaborators")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._clauses = None # clause_id -> clause
+        self._collaborators = None # user_id -> collaborator
+
+    def __reduce__(self):
+        # Indexes are rebuilt on demand, e.g. after pickling a contract for an export worker process
+        return (Contract, (dict(self),))
+
+    def reindex(self):
+        self._clauses = None
+        self._collaborators = None
+
+    def clause(self, clause_id):
+        if self._clauses is None:
+            self._clauses = {clause["clause_id"]: clause for clause in self["clauses"]}
+        return self._clauses.get(clause_id)
+
+    def collaborator(self, user_id):
+        if self._collaborators is None:
+            self._collaborators = {collab["user_id"]: collab for collab in self["metadata"]["collaborators"]}
+        return self._collaborators.get(user_id)
+
+    def clause_added(self, clause):
+        if self._clauses is not None:
+            self._clauses[clause["clause_id"]] = clause
+
+    def clause_removed(self, clause_id):
+        if self._clauses is not None:
+            self._clauses.pop(clause_id, None)
+
+    def collaborator_added(self, collaborator):
+        if self._collaborators is not None:
+            self._collaborators[collaborator["user_id"]] = collaborator
+
+    def collaborator_removed(self, user_id):
+        if self._collaborators is not None:
+            self._collaborators.pop(user_id, None)
+
+
+def find_clause(contract, clause_id):
+    if isinstance(contract, Contract):
+        return contract.clause(clause_id)
+    return next((clause for clause in contract["clauses"] if clause["clause_id"] == clause_id), None)
+
+
+def find_collaborator(contract, user_id):
+    if isinstance(contract, Contract):
+        return contract.collaborator(user_id)
+    return next((collab for collab in contract["metadata"]["collaborators"] if collab["user_id"] == user_id), None)
+
+
+def contract_role(contract, user_id):
+    """"Creator", the user's collaborator role, or None if the user has no access."""
+    if contract["metadata"]["creator_id"] == user_id:
+        return "Creator"
+    collaborator = find_collaborator(contract, user_id)
+    return collaborator["role"] if collaborator else None
@@ -0,0 +1,75 @@
+'''Contract mutations expressed as small operation records.
+
+Core validates a request, describes the change as an operation and applies it with apply_operation.
+The same records are appended to the per-contract operation log, and replayed to rebuild a contract from
+its last snapshot. Every applied operation bumps contract["metadata"]["revision"].
+'''
+from model import Contract, find_clause, find_collaborator
+from versions import push_version
+
+
+def apply_operation(contract, op):
+    """Apply one operation record to a contract in memory."""
+    kind = op["op"]
+    metadata = contract["metadata"]
+    indexed = isinstance(contract, Contract) # keep its lookups up to date
+
+    if kind == "add_clause":
+        contract["clauses"].append(op["clause"])
+        if indexed:
+            contract.clause_added(op["clause"])
+
+    elif kind == "update_clause":
+        clause = find_clause(contract, op["clause_id"])
+        push_version(clause["versions"], op["version"])
+        if op.get("short_title"):
+            clause["short_title"] = op["short_title"]
+
+    elif kind == "delete_clause":
+        clause = find_clause(contract, op["clause_id"])
+        if clause:
+            contract["clauses"].remove(clause)
+            if indexed:
+                contract.clause_removed(op["clause_id"])
+
+    elif kind == "move_clause":
+        clauses = contract["clauses"]
+        clause = find_clause(contract, op["clause_id"])
+        clauses.remove(clause)
+        if op["index"] < 0 or op["index"] >= len(clauses):
+            clauses.append(clause) # Move to end if index is out of bounds
+        else:
+            clauses.insert(op["index"], clause)
+
+    elif kind == "add_collaborator":
+        metadata["collaborators"].append(op["collaborator"])
+        if indexed:
+            contract.collaborator_added(op["collaborator"])
+
+    elif kind == "remove_collaborator":
+        collaborator = find_collaborator(contract, op["user_id"])
+        if collaborator:
+            metadata["collaborators"].remove(collaborator)
+            if indexed:
+                contract.collaborator_removed(op["user_id"])
+
+    elif kind == "update_role":
+        collaborator = find_collaborator(contract, op["user_id"])
+        if collaborator:
+            collaborator["role"] = op["role"]
+
+    elif kind == "add_comment":
+        clause = find_clause(contract, op["clause_id"])
+        clause.setdefault("comments", []).append(op["comment"])
+
+    elif kind == "delete_comment":
+        clause = find_clause(contract, op["clause_id"])
+        clause["comments"] = [comment for comment in clause["comments"] if comment["comment_id"] != op["comment_id"]]
+
+    elif kind == "set_status":
+        metadata["status"] = op["status"]
+
+    else:
+        raise ValueError(f"Unknown contract operation: {kind}")
+
+    metadata["revision"] = metadata.get("revision", 0) + 1
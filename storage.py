@@ -0,0 +1,616 @@
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+from codec import SNAPSHOT_FORMATS, decode_contract, decode_record, encode_contract, encode_record, snapshot_extension
+from connections import ConnectionPool
+from model import Contract
+from operations import apply_operation
+from versions import compress_versions
+
+
+class ContractStore:
+    """Storage backend interface used by Core.
+
+    Callers hold the contract's lock from ContractLocks: the read lock for read(use_cache=True), the write lock
+    for everything else. Contracts returned with use_cache=True are shared and must not be modified; any other
+    read returns a private copy that the caller may edit and persist with commit().
+    """
+
+    def read(self, contract_id, use_cache=False):
+        """Load a contract, or return None if it doesn't exist. Raises ValueError if it exists but is corrupt."""
+        raise NotImplementedError
+
+    def write(self, contract):
+        """Store a whole contract, replacing any previous copy."""
+        raise NotImplementedError
+
+    def commit(self, contract, records):
+        """Persist a contract that already has the given operation records (see operations.py) applied."""
+        raise NotImplementedError
+
+    def write_many(self, contracts, batch_size=500):
+        """Store many contracts, e.g. during a migration. Returns how many were written."""
+        count = 0
+        for contract in contracts:
+            self.write(contract)
+            count += 1
+        return count
+
+    def delete(self, contract_id):
+        """Delete a contract. Returns False if it didn't exist."""
+        raise NotImplementedError
+
+    def list_ids(self):
+        raise NotImplementedError
+
+
+class JsonFileStore(ContractStore):
+    """Contracts stored as one snapshot file per contract in a directory.
+
+    Snapshots are written in snapshot_format (see codec.py): compact JSON in <contract_id>.json by default,
+    indented JSON with "pretty", or MessagePack in <contract_id>.msgpack. Snapshots in the other file format are
+    still read, and replaced the next time the contract is written.
+
+    With log_operations, mutations are appended as compact operation records to <contract_id>.log instead of
+    rewriting the snapshot. Reads rebuild the contract from the snapshot plus the log tail, and a background
+    thread folds the log into a new snapshot once it passes compact_ops records or compact_bytes bytes.
+    A log left behind is always replayed on read, whichever mode is active.
+    """
+
+    def __init__(self, directory, locks, cache, log_operations=False, compact_ops=200, compact_bytes=256 * 1024,
+                 snapshot_format="json"):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f"Invalid snapshot format. Must be one of: {', '.join(SNAPSHOT_FORMATS)}")
+        self.directory = directory
+        self.snapshot_format = snapshot_format
+        self.locks = locks
+        self.cache = cache
+        self.log_operations = log_operations
+        self.compact_ops = compact_ops
+        self.compact_bytes = compact_bytes
+        self._log_ops = {} # contract_id -> records in the log, as seen by this process
+        self._compaction_queue = queue.Queue()
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if log_operations:
+            threading.Thread(target=self._compactor, name="contract-compactor", daemon=True).start()
+
+    def path(self, contract_id, snapshot_format=None):
+        return f"{self.directory}/{contract_id}{snapshot_extension(snapshot_format or self.snapshot_format)}"
+
+    def _other_path(self, contract_id):
+        """Where a snapshot written in the other file format (JSON or MessagePack) would be."""
+        return self.path(contract_id, "json" if self.snapshot_format == "msgpack" else "msgpack")
+
+    def _snapshot_stat(self, contract_id):
+        try:
+            return os.stat(self.path(contract_id))
+        except FileNotFoundError:
+            return os.stat(self._other_path(contract_id))
+
+    def _open_snapshot(self, contract_id):
+        """Open a contract's snapshot, in the configured file format or else the other one. Returns (file, format)."""
+        try:
+            return open(self.path(contract_id), "rb"), self.snapshot_format
+        except FileNotFoundError:
+            other_path = self._other_path(contract_id)
+            return open(other_path, "rb"), "msgpack" if other_path.endswith(".msgpack") else "json"
+
+    def log_path(self, contract_id):
+        return f"{self.directory}/{contract_id}.log"
+
+    def _revision(self, snapshot_stat, log_stat):
+        # A snapshot save renames a new file into place and log appends grow the log,
+        # so any change shows up in the inode, mtime or size of one of the two files
+        revision = (snapshot_stat.st_ino, snapshot_stat.st_mtime_ns, snapshot_stat.st_size)
+        if log_stat:
+            revision += (log_stat.st_mtime_ns, log_stat.st_size)
+        return revision
+
+    def _log_stat(self, contract_id):
+        try:
+            return os.stat(self.log_path(contract_id))
+        except FileNotFoundError:
+            return None
+
+    def read(self, contract_id, use_cache=False):
+        try:
+            f, snapshot_format = self._open_snapshot(contract_id)
+            with f:
+                snapshot_stat = os.fstat(f.fileno())
+                log_stat = self._log_stat(contract_id)
+                revision = self._revision(snapshot_stat, log_stat)
+                if use_cache:
+                    contract = self.cache.get(contract_id, revision)
+                    if contract is not None:
+                        return contract
+                contract = decode_contract(f.read(), snapshot_format)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            # A corrupt snapshot must not look like a missing contract, which could then be recreated over it
+            print(f"Error reading contract {contract_id}: {e}")
+            raise
+
+        if log_stat:
+            self._replay(contract_id, contract)
+        if use_cache:
+            self.cache.put(contract_id, revision, snapshot_stat.st_size + (log_stat.st_size if log_stat else 0), contract)
+        return contract
+
+    def _replay(self, contract_id, contract):
+        applied = 0
+        try:
+            with open(self.log_path(contract_id), "rb") as f:
+                for line in f:
+                    try:
+                        record = decode_record(line)
+                    except ValueError:
+                        continue # Torn record from a crash mid-append
+                    # Records already folded into the snapshot are skipped, e.g. after a crash mid-compaction
+                    if record["rev"] <= contract["metadata"].get("revision", 0):
+                        continue
+                    apply_operation(contract, record)
+                    applied += 1
+        except FileNotFoundError:
+            pass
+        self._log_ops[contract_id] = applied
+
+    def write(self, contract):
+        """Write a full snapshot atomically (temp file + rename) and drop the folded-in operation log.
+        The contract is cached as-is afterwards, so it must not be modified once written."""
+        contract_id = contract["metadata"]["contract_id"]
+        contract_path = self.path(contract_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encode_contract(contract, self.snapshot_format))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, contract_path)
+        except BaseException:
+            self.cache.invalidate(contract_id)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # The snapshot carries the revision of the last folded record, so the log can go once it is in place,
+        # and so can a snapshot in the other file format
+        for path in (self.log_path(contract_id), self._other_path(contract_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._log_ops.pop(contract_id, None)
+        # The saved object becomes the cached copy, so the next read doesn't have to parse it again
+        stat = os.stat(contract_path)
+        self.cache.put(contract_id, self._revision(stat, None), stat.st_size, contract)
+
+    def commit(self, contract, records):
+        if not self.log_operations:
+            self.write(contract)
+            return
+
+        contract_id = contract["metadata"]["contract_id"]
+        try:
+            with open(self.log_path(contract_id), "a+b") as f:
+                # Terminate a torn record left by a crash, so it can't swallow the next one
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+                f.write(b"".join(encode_record(record) + b"\n" for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+                log_stat = os.fstat(f.fileno())
+            snapshot_stat = self._snapshot_stat(contract_id)
+        except BaseException:
+            self.cache.invalidate(contract_id)
+            raise
+        self.cache.put(contract_id, self._revision(snapshot_stat, log_stat), snapshot_stat.st_size + log_stat.st_size, contract)
+
+        self._log_ops[contract_id] = self._log_ops.get(contract_id, 0) + len(records)
+        if self._log_ops[contract_id] >= self.compact_ops or log_stat.st_size >= self.compact_bytes:
+            self._schedule_compaction(contract_id)
+
+    def _schedule_compaction(self, contract_id):
+        with self._queued_lock:
+            if contract_id in self._queued:
+                return
+            self._queued.add(contract_id)
+        self._compaction_queue.put(contract_id)
+
+    def _compactor(self):
+        while True:
+            contract_id = self._compaction_queue.get()
+            with self._queued_lock:
+                self._queued.discard(contract_id)
+            try:
+                self.compact(contract_id)
+            except Exception as e:
+                print(f"Error compacting contract {contract_id}: {e}")
+
+    def compact(self, contract_id):
+        """Fold a contract's operation log into a new snapshot."""
+        with self.locks.write(contract_id):
+            if not os.path.exists(self.log_path(contract_id)):
+                return
+            contract = self.read(contract_id)
+            if contract:
+                self.write(contract)
+
+    def delete(self, contract_id):
+        self.cache.invalidate(contract_id)
+        try:
+            os.remove(self.log_path(contract_id))
+        except FileNotFoundError:
+            pass
+        self._log_ops.pop(contract_id, None)
+        deleted = False
+        for path in (self.path(contract_id), self._other_path(contract_id)):
+            try:
+                os.remove(path)
+                deleted = True
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    def list_ids(self):
+        contract_ids = set()
+        for filename in os.listdir(self.directory):
+            for extension in (".json", ".msgpack"):
+                if filename.endswith(extension):
+                    contract_ids.add(filename[:-len(extension)])
+        return list(contract_ids)
+
+
+def _version_size(version):
+    if "full_text" in version:
+        return len(version["full_text"]) + 128
+    return sum(len(replacement) + 64 for _, _, replacement in version["delta"]) + 128
+
+
+def _approximate_size(contract):
+    """Rough in-memory weight of a contract for the cache, dominated by clause and comment text."""
+    size = 1024
+    for clause in contract["clauses"]:
+        size += sum(_version_size(version) for version in clause["versions"])
+        size += sum(len(comment["comment"]) + 256 for comment in clause.get("comments", []))
+    return size
+
+
+class SQLiteStore(ContractStore):
+    """Contracts stored in normalized SQLite tables: one row per contract, collaborator, clause, clause version and comment.
+
+    Operation records are translated into row changes, so e.g. a clause edit inserts a single version row instead
+    of rewriting the document. contract_documents.store_revision is bumped on every change and validates the cache.
+
+    Clause texts of SHARED_TEXT_MIN characters or more are stored once in clause_texts, keyed by their SHA-256,
+    and version rows refer to them by text_hash. Contracts created from the same template therefore share their
+    clause texts. clause_texts.refs counts the version rows using a text; it is dropped when that reaches zero.
+    """
+
+    SHARED_TEXT_MIN = 128 # shorter texts stay inline, where they cost less than a hash and a lookup
+
+    def __init__(self, db_path, cache):
+        self.db_path = db_path
+        self.cache = cache
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.pool = ConnectionPool(self.db_path)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS contract_documents
+                                (contract_id TEXT PRIMARY KEY, creator_id TEXT, creator_name TEXT, title TEXT, description TEXT,
+                                 creation_date TEXT, status TEXT, revision INTEGER, store_revision INTEGER)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS contract_collaborators
+                                (contract_id TEXT, user_id TEXT, name TEXT, email TEXT, role TEXT, added_date TEXT, position INTEGER,
+                                 PRIMARY KEY (contract_id, user_id))''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS clauses
+                                (clause_id TEXT PRIMARY KEY, contract_id TEXT, short_title TEXT, position INTEGER)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clauses_contract ON clauses (contract_id, position)')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS clause_versions
+                                (version_id INTEGER PRIMARY KEY AUTOINCREMENT, contract_id TEXT, clause_id TEXT, date TEXT, full_text TEXT,
+                                 publisher TEXT, publisher_id TEXT, publisher_name TEXT, delta TEXT)''')
+            cursor.execute('PRAGMA table_info(clause_versions)')
+            if "delta" not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE clause_versions ADD COLUMN delta TEXT') # databases created before version deltas
+            cursor.execute('PRAGMA table_info(clause_versions)')
+            if "text_hash" not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE clause_versions ADD COLUMN text_hash TEXT') # and before shared texts
+            cursor.execute('CREATE TABLE IF NOT EXISTS clause_texts (text_hash TEXT PRIMARY KEY, full_text TEXT, refs INTEGER)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clause_versions_contract ON clause_versions (contract_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clause_versions_clause ON clause_versions (clause_id, version_id)')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS clause_comments
+                                (comment_id TEXT PRIMARY KEY, contract_id TEXT, clause_id TEXT, user_id TEXT, email TEXT, name TEXT,
+                                 comment TEXT, date TEXT)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clause_comments_contract ON clause_comments (contract_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_clause_comments_clause ON clause_comments (clause_id)')
+            conn.commit()
+
+    def read(self, contract_id, use_cache=False):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT store_revision FROM contract_documents WHERE contract_id = ?', (contract_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            revision = row[0]
+            if use_cache:
+                contract = self.cache.get(contract_id, revision)
+                if contract is not None:
+                    return contract
+            contract = self._load(cursor, contract_id)
+        if use_cache:
+            self.cache.put(contract_id, revision, _approximate_size(contract), contract)
+        return contract
+
+    def _load(self, cursor, contract_id):
+        """Assemble a contract dict from its rows."""
+        cursor.execute('''SELECT creator_id, creator_name, title, description, creation_date, status, revision
+                          FROM contract_documents WHERE contract_id = ?''', (contract_id,))
+        row = cursor.fetchone()
+        metadata = {
+            "contract_id": contract_id,
+            "creator_id": row[0],
+            "creator_name": row[1],
+            "title": row[2],
+            "description": row[3],
+            "creation_date": row[4],
+            "status": row[5],
+            "collaborators": [],
+            "revision": row[6]
+        }
+        cursor.execute('''SELECT user_id, name, email, role, added_date FROM contract_collaborators
+                          WHERE contract_id = ? ORDER BY position''', (contract_id,))
+        for row in cursor.fetchall():
+            metadata["collaborators"].append({"user_id": row[0], "name": row[1], "email": row[2], "role": row[3], "added_date": row[4]})
+
+        clauses = {}
+        cursor.execute('SELECT clause_id, short_title FROM clauses WHERE contract_id = ? ORDER BY position', (contract_id,))
+        for row in cursor.fetchall():
+            clauses[row[0]] = {"clause_id": row[0], "short_title": row[1], "versions": [], "comments": []}
+
+        # Versions are kept newest first, like the JSON documents
+        cursor.execute('''SELECT versions.clause_id, versions.date, COALESCE(versions.full_text, texts.full_text), versions.publisher,
+                                 versions.publisher_id, versions.publisher_name, versions.delta
+                          FROM clause_versions AS versions LEFT JOIN clause_texts AS texts ON texts.text_hash = versions.text_hash
+                          WHERE versions.contract_id = ? ORDER BY versions.version_id DESC''', (contract_id,))
+        for row in cursor.fetchall():
+            version = {"date": row[1]}
+            if row[6] is None:
+                version["full_text"] = row[2]
+            else:
+                version["delta"] = json.loads(row[6])
+            for key, value in (("publisher", row[3]), ("publisher_id", row[4]), ("publisher_name", row[5])):
+                if value is not None:
+                    version[key] = value
+            clauses[row[0]]["versions"].append(version)
+        cursor.execute('''SELECT clause_id, comment_id, user_id, email, name, comment, date FROM clause_comments
+                          WHERE contract_id = ? ORDER BY rowid''', (contract_id,))
+        for row in cursor.fetchall():
+            clauses[row[0]]["comments"].append({
+                "comment_id": row[1], "user_id": row[2], "email": row[3], "name": row[4], "comment": row[5], "date": row[6]
+            })
+
+        return Contract(metadata=metadata, clauses=list(clauses.values()))
+
+    def _insert_clause(self, cursor, contract_id, clause, position):
+        cursor.execute('INSERT INTO clauses (clause_id, contract_id, short_title, position) VALUES (?, ?, ?, ?)',
+                       (clause["clause_id"], contract_id, clause["short_title"], position))
+        for version in reversed(clause["versions"]): # oldest first, so newer versions get higher ids
+            self._insert_version(cursor, contract_id, clause["clause_id"], version)
+        for comment in clause.get("comments", []):
+            self._insert_comment(cursor, contract_id, clause["clause_id"], comment)
+
+    def _text_hash(self, text):
+        """Key of a text in clause_texts, or None if the text is kept inline."""
+        if text is None or len(text) < self.SHARED_TEXT_MIN:
+            return None
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _store_text(self, cursor, text):
+        """Take a reference to a version text. Returns its (full_text, text_hash) columns: one of them is None."""
+        text_hash = self._text_hash(text)
+        if text_hash is None:
+            return text, None
+        cursor.execute('''INSERT INTO clause_texts (text_hash, full_text, refs) VALUES (?, ?, 1)
+                          ON CONFLICT (text_hash) DO UPDATE SET refs = refs + 1''', (text_hash, text))
+        return None, text_hash
+
+    def _release_texts(self, cursor, condition, params):
+        """Drop the references held by the version rows matching condition, before they are deleted or re-encoded."""
+        cursor.execute(f'''SELECT text_hash, COUNT(*) FROM clause_versions WHERE {condition} AND text_hash IS NOT NULL
+                           GROUP BY text_hash''', params)
+        released = cursor.fetchall()
+        cursor.executemany('UPDATE clause_texts SET refs = refs - ? WHERE text_hash = ?', [(count, text_hash) for text_hash, count in released])
+        cursor.executemany('DELETE FROM clause_texts WHERE text_hash = ? AND refs <= 0', [(text_hash,) for text_hash, _ in released])
+
+    def _insert_version(self, cursor, contract_id, clause_id, version):
+        full_text, text_hash = self._store_text(cursor, version.get("full_text"))
+        cursor.execute('''INSERT INTO clause_versions
+                          (contract_id, clause_id, date, full_text, text_hash, publisher, publisher_id, publisher_name, delta)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (contract_id, clause_id, version["date"], full_text, text_hash,
+                        version.get("publisher"), version.get("publisher_id"), version.get("publisher_name"), self._delta_column(version)))
+
+    def _delta_column(self, version):
+        return json.dumps(version["delta"], separators=(",", ":")) if "delta" in version else None
+
+    def _sync_version_encodings(self, cursor, clause, count):
+        """Store the newest count versions of a clause the way push_version left them in memory (full text or delta)."""
+        cursor.execute('SELECT version_id, text_hash FROM clause_versions WHERE clause_id = ? ORDER BY version_id DESC LIMIT ?',
+                       (clause["clause_id"], count))
+        for (version_id, text_hash), version in zip(cursor.fetchall(), clause["versions"]):
+            full_text = version.get("full_text")
+            if self._text_hash(full_text) != text_hash: # e.g. the previous latest version became a delta
+                self._release_texts(cursor, 'version_id = ?', (version_id,))
+                full_text, text_hash = self._store_text(cursor, full_text)
+            elif text_hash is not None:
+                full_text = None
+            cursor.execute('UPDATE clause_versions SET full_text = ?, text_hash = ?, delta = ? WHERE version_id = ?',
+                           (full_text, text_hash, self._delta_column(version), version_id))
+
+    def _sync_positions(self, cursor, contract):
+        """Store the in-memory clause order, updating only the clauses whose position changed."""
+        cursor.execute('SELECT clause_id, position FROM clauses WHERE contract_id = ?', (contract["metadata"]["contract_id"],))
+        stored = dict(cursor.fetchall())
+        cursor.executemany('UPDATE clauses SET position = ? WHERE clause_id = ?',
+                           [(position, clause["clause_id"]) for position, clause in enumerate(contract["clauses"])
+                            if stored.get(clause["clause_id"]) != position])
+
+    def _insert_comment(self, cursor, contract_id, clause_id, comment):
+        cursor.execute('''INSERT INTO clause_comments (comment_id, contract_id, clause_id, user_id, email, name, comment, date)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (comment["comment_id"], contract_id, clause_id, comment["user_id"], comment["email"],
+                        comment["name"], comment["comment"], comment["date"]))
+
+    def _insert_collaborator(self, cursor, contract_id, collaborator, position):
+        cursor.execute('''INSERT INTO contract_collaborators (contract_id, user_id, name, email, role, added_date, position)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                       (contract_id, collaborator["user_id"], collaborator.get("name"), collaborator.get("email"),
+                        collaborator.get("role"), collaborator.get("added_date"), position))
+
+    def _delete_rows(self, cursor, contract_id):
+        self._release_texts(cursor, 'contract_id = ?', (contract_id,))
+        for table in ("clause_comments", "clause_versions", "clauses", "contract_collaborators", "contract_documents"):
+            cursor.execute(f'DELETE FROM {table} WHERE contract_id = ?', (contract_id,))
+
+    def _write(self, cursor, contract):
+        metadata = contract["metadata"]
+        contract_id = metadata["contract_id"]
+        cursor.execute('SELECT store_revision FROM contract_documents WHERE contract_id = ?', (contract_id,))
+        row = cursor.fetchone()
+        store_revision = row[0] + 1 if row else 1
+        self._delete_rows(cursor, contract_id)
+        cursor.execute('''INSERT INTO contract_documents
+                          (contract_id, creator_id, creator_name, title, description, creation_date, status, revision, store_revision)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (contract_id, metadata["creator_id"], metadata["creator_name"], metadata["title"], metadata["description"],
+                        metadata["creation_date"], metadata["status"], metadata.get("revision", 0), store_revision))
+        for position, collaborator in enumerate(metadata["collaborators"]):
+            self._insert_collaborator(cursor, contract_id, collaborator, position)
+        for position, clause in enumerate(contract["clauses"]):
+            self._insert_clause(cursor, contract_id, clause, position)
+        return store_revision
+
+    def write(self, contract):
+        contract_id = contract["metadata"]["contract_id"]
+        self.cache.invalidate(contract_id)
+        with self.pool.connection() as conn:
+            store_revision = self._write(conn.cursor(), contract)
+            conn.commit()
+        # The saved object becomes the cached copy, so it must not be modified once written
+        self.cache.put(contract_id, store_revision, _approximate_size(contract), contract)
+
+    def write_many(self, contracts, batch_size=500):
+        """Bulk insert contracts, committing every batch_size contracts. Returns how many were written."""
+        count = 0
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            for contract in contracts:
+                self.cache.invalidate(contract["metadata"]["contract_id"])
+                self._write(cursor, contract)
+                count += 1
+                if count % batch_size == 0:
+                    conn.commit()
+            conn.commit()
+        return count
+
+    def _apply_record(self, cursor, contract_id, record):
+        kind = record["op"]
+        if kind == "add_clause":
+            cursor.execute('SELECT COUNT(*) FROM clauses WHERE contract_id = ?', (contract_id,))
+            self._insert_clause(cursor, contract_id, record["clause"], cursor.fetchone()[0])
+        elif kind == "update_clause":
+            self._insert_version(cursor, contract_id, record["clause_id"], record["version"])
+            if record.get("short_title"):
+                cursor.execute('UPDATE clauses SET short_title = ? WHERE clause_id = ?', (record["short_title"], record["clause_id"]))
+        elif kind == "delete_clause":
+            cursor.execute('SELECT position FROM clauses WHERE clause_id = ? AND contract_id = ?', (record["clause_id"], contract_id))
+            row = cursor.fetchone()
+            if row:
+                self._release_texts(cursor, 'clause_id = ?', (record["clause_id"],))
+                for table in ("clause_comments", "clause_versions", "clauses"):
+                    cursor.execute(f'DELETE FROM {table} WHERE clause_id = ?', (record["clause_id"],))
+                cursor.execute('UPDATE clauses SET position = position - 1 WHERE contract_id = ? AND position > ?', (contract_id, row[0]))
+        elif kind == "move_clause":
+            pass # positions are renumbered once per commit, see _sync_positions
+        elif kind == "add_collaborator":
+            cursor.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM contract_collaborators WHERE contract_id = ?', (contract_id,))
+            self._insert_collaborator(cursor, contract_id, record["collaborator"], cursor.fetchone()[0])
+        elif kind == "remove_collaborator":
+            cursor.execute('DELETE FROM contract_collaborators WHERE contract_id = ? AND user_id = ?', (contract_id, record["user_id"]))
+        elif kind == "update_role":
+            cursor.execute('UPDATE contract_collaborators SET role = ? WHERE contract_id = ? AND user_id = ?',
+                           (record["role"], contract_id, record["user_id"]))
+        elif kind == "add_comment":
+            self._insert_comment(cursor, contract_id, record["clause_id"], record["comment"])
+        elif kind == "delete_comment":
+            cursor.execute('DELETE FROM clause_comments WHERE comment_id = ?', (record["comment_id"],))
+        elif kind == "set_status":
+            cursor.execute('UPDATE contract_documents SET status = ? WHERE contract_id = ?', (record["status"], contract_id))
+        else:
+            raise ValueError(f"Unknown contract operation: {kind}")
+
+    def commit(self, contract, records):
+        contract_id = contract["metadata"]["contract_id"]
+        self.cache.invalidate(contract_id)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            edited = {} # clause_id -> new versions added by these records
+            for record in records:
+                self._apply_record(cursor, contract_id, record)
+                if record["op"] == "update_clause":
+                    edited[record["clause_id"]] = edited.get(record["clause_id"], 0) + 1
+            # However many clauses were moved, the new order is written once
+            if any(record["op"] == "move_clause" for record in records):
+                self._sync_positions(cursor, contract)
+            # A new version turns the previous latest one into a delta, so re-encode the rows just below the new ones
+            for clause in contract["clauses"]:
+                if clause["clause_id"] in edited:
+                    self._sync_version_encodings(cursor, clause, edited[clause["clause_id"]] + 1)
+            cursor.execute('UPDATE contract_documents SET revision = ?, store_revision = store_revision + 1 WHERE contract_id = ?',
+                           (contract["metadata"]["revision"], contract_id))
+            cursor.execute('SELECT store_revision FROM contract_documents WHERE contract_id = ?', (contract_id,))
+            store_revision = cursor.fetchone()[0]
+            conn.commit()
+        self.cache.put(contract_id, store_revision, _approximate_size(contract), contract)
+
+    def delete(self, contract_id):
+        self.cache.invalidate(contract_id)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM contract_documents WHERE contract_id = ?', (contract_id,))
+            if not cursor.fetchone():
+                return False
+            self._delete_rows(cursor, contract_id)
+            conn.commit()
+        return True
+
+    def list_ids(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT contract_id FROM contract_documents')
+            return [row[0] for row in cursor.fetchall()]
+
+
+def _compress_history(contract):
+    for clause in contract["clauses"]:
+        clause["versions"] = compress_versions(clause["versions"])
+    return contract
+
+
+def migrate_contracts(source, target, batch_size=500, compress_history=False):
+    """Copy every contract from one store to another, e.g. from a JsonFileStore into a SQLiteStore.
+    With compress_history, clause histories are re-encoded as deltas on the way (see versions.py).
+    Run it while the app is stopped. Returns the number of contracts copied."""
+    contracts = (source.read(contract_id) for contract_id in source.list_ids())
+    contracts = (contract for contract in contracts if contract)
+    if compress_history:
+        contracts = (_compress_history(contract) for contract in contracts)
+    return target.write_many(contracts, batch_size=batch_size)
@@ -0,0 +1,95 @@
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+_TEMPLATE_NAME = re.compile(r'[\w-]+')
+
+
+class TemplateRegistry:
+    """Contract templates (<name>.json files in a directory), validated and kept in memory.
+
+    Lookups never touch the disk. A background thread compares the files' mtimes with the loaded ones every
+    check_interval seconds and reloads whatever was added, changed or removed. Files that aren't valid templates,
+    or whose names aren't safe, are skipped with a warning.
+    """
+
+    def __init__(self, directory, check_interval=5):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._templates = {} # name -> template, replaced as a whole on reload
+        self._mtimes = {} # file name -> mtime it was loaded at
+        self._lock = threading.Lock()
+        self.reload()
+        threading.Thread(target=self._watch, name="template-watcher", daemon=True).start()
+
+    def _parse(self, name, path, mtime):
+        """Load a template file into {"name", "description", "clause_count", "updated_at", "clauses"}, or None if it is invalid."""
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            clauses = [{
+                "short_title": str(clause["short_title"]),
+                "versions": [{"full_text": str(clause["versions"][0]["full_text"])}]
+            } for clause in data["clauses"]]
+        except (OSError, ValueError, TypeError, KeyError, IndexError) as e:
+            print(f"Skipping invalid template {name}: {e!r}")
+            return None
+        return {
+            "name": name,
+            "description": data.get("description", ""),
+            "clause_count": len(clauses),
+            "updated_at": datetime.fromtimestamp(mtime).isoformat(),
+            "clauses": clauses
+        }
+
+    def _scan(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json") and entry.is_file()]
+        except FileNotFoundError:
+            entries = []
+        templates, mtimes = {}, {}
+        for entry in entries:
+            name = entry.name[:-len(".json")]
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue # removed since the directory was listed
+            mtimes[entry.name] = mtime
+            if self._mtimes.get(entry.name) == mtime:
+                template = self._templates.get(name) # unchanged, or still skipped
+            elif not _TEMPLATE_NAME.fullmatch(name):
+                print(f"Skipping template with unsafe name: {entry.name}")
+                template = None
+            else:
+                template = self._parse(name, entry.path, mtime)
+            if template:
+                templates[name] = template
+        self._templates, self._mtimes = templates, mtimes
+
+    def reload(self):
+        """Bring the registry up to date with the directory, reparsing only files whose mtime changed."""
+        with self._lock:
+            self._scan()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"Error reloading templates: {e}")
+
+    def get(self, name):
+        """Return a template, or None if there is none by that name. Raises ValueError for an unsafe name.
+        The result is shared and must not be modified."""
+        if not isinstance(name, str) or not _TEMPLATE_NAME.fullmatch(name):
+            raise ValueError("Invalid template name")
+        return self._templates.get(name)
+
+    def list(self):
+        """Metadata of every template, by name."""
+        return [{key: value for key, value in template.items() if key != "clauses"}
+                for _, template in sorted(self._templates.items())]
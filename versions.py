@@ -0,0 +1,98 @@
+'''Delta-compressed clause version history.
+
+A clause's versions are kept newest first. The newest version always has its full_text. Older versions usually
+store a "delta" instead: the edits that turn the next newer text back into theirs, as [[start, end, text], ...]
+character spans. Every KEYFRAME_INTERVAL versions, when a delta wouldn't be smaller than the text itself, or
+when either text has more than MAX_DELTA_TOKENS words (diffing is quadratic in the worst case), a version keeps
+its full_text as a keyframe, so rebuilding any version walks a bounded chain.
+'''
+import difflib
+import re
+
+KEYFRAME_INTERVAL = 32
+MAX_DELTA_TOKENS = 2000
+
+_TOKEN = re.compile(r'\S+\s*|\s+') # diff whole words with their trailing whitespace, not characters
+
+
+def make_delta(new_text, old_text):
+    """Edits that turn new_text into old_text, or None if either text is too long to diff."""
+    new_tokens = _TOKEN.findall(new_text)
+    old_tokens = _TOKEN.findall(old_text)
+    if len(new_tokens) > MAX_DELTA_TOKENS or len(old_tokens) > MAX_DELTA_TOKENS:
+        return None
+    offsets = [0]
+    for token in new_tokens:
+        offsets.append(offsets[-1] + len(token))
+
+    matcher = difflib.SequenceMatcher(None, new_tokens, old_tokens, autojunk=False)
+    return [
+        [offsets[i1], offsets[i2], "".join(old_tokens[j1:j2])]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"
+    ]
+
+
+def apply_delta(text, delta):
+    parts = []
+    position = 0
+    for start, end, replacement in delta:
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def push_version(versions, version):
+    """Insert a new latest version (with full_text), turning the previous latest into a delta where that pays off."""
+    if versions and isinstance(versions[0].get("full_text"), str) and isinstance(version["full_text"], str):
+        # Number of deltas right below the previous latest version, i.e. the chain it would extend
+        chain = 0
+        for older in versions[1:KEYFRAME_INTERVAL]:
+            if "full_text" in older:
+                break
+            chain += 1
+        previous_text = versions[0]["full_text"]
+        if chain < KEYFRAME_INTERVAL - 1:
+            delta = make_delta(version["full_text"], previous_text)
+            if delta is not None and sum(len(replacement) + 16 for _, _, replacement in delta) < len(previous_text):
+                # Replace rather than modify the dict: operation records may still reference it
+                previous = {key: value for key, value in versions[0].items() if key != "full_text"}
+                previous["delta"] = delta
+                versions[0] = previous
+    versions.insert(0, version)
+
+
+def compress_versions(versions):
+    """Re-encode a whole history (e.g. a legacy one with full copies of every version). Returns a new list."""
+    compressed = []
+    for version in reversed(expand_versions(versions)):
+        push_version(compressed, version)
+    return compressed
+
+
+def expand_versions(versions):
+    """Return the history with every version's full_text filled in (and no deltas). Doesn't modify versions."""
+    expanded = []
+    text = None
+    for version in versions:
+        if "full_text" in version:
+            text = version["full_text"]
+            expanded.append(version)
+        else:
+            text = apply_delta(text, version["delta"])
+            full = {key: value for key, value in version.items() if key != "delta"}
+            full["full_text"] = text
+            expanded.append(full)
+    return expanded
+
+
+def version_text(versions, number):
+    """Full text of versions[number] (0 is the latest), rebuilt from the nearest newer keyframe."""
+    start = number
+    while "full_text" not in versions[start]:
+        start -= 1
+    text = versions[start]["full_text"]
+    for version in versions[start + 1:number + 1]:
+        text = apply_delta(text, version["delta"])
+    return text
@@ -0,0 +1,13 @@
+'''WSGI entry point for running the app under a multi-worker server, e.g.
+
+    gunicorn --workers 4 --bind 0.0.0.0:8081 wsgi:app
+
+Worker processes share ../store/json, so contract access is coordinated with fcntl file locks.
+'''
+import os
+
+os.environ.setdefault("CONTRACTS_MULTIPROCESS", "1")
+
+from main import create_app
+
+app = create_app()